@@ -0,0 +1,57 @@
+'''Frames of the animated scatter of two metrics over time, one point per state.
+
+Instead of px.scatter(animation_frame='date', animation_group='state'),
+which groups the frame by date once per frame and ships every frame with
+the figure, frames are the date rows of the metrics' (date x state)
+matrices in Dataset.cube. The browser first gets the dates, states and axis
+ranges (animation_base), then the frames in chunks of CHUNK_DAYS rows
+(animation_chunk) as playback or the slider reaches them, see
+ctp.animationFigure in assets/figures.js.
+'''
+import os
+
+import numpy as np
+
+import figures
+
+CHUNK_DAYS = int(os.environ.get('CTP_ANIMATION_CHUNK_DAYS', 30))
+
+
+def chunk_count(dataset):
+    return -(-len(dataset.cube.dates) // CHUNK_DAYS)
+
+
+def animation_base(dataset, x, y, title):
+    '''Everything but the frames: dates, states, colors and the axis ranges
+    covering the whole history, so the axes hold still during playback'''
+    cube = dataset.cube
+    states = cube.states
+    x_values, y_values = cube.metric(x), cube.metric(y)
+    names = dataset.states['state_name'].reindex(states)
+    ranges = []
+    for values in (x_values, y_values):
+        top = np.nanmax(values) if np.isfinite(values).any() else 0
+        ranges.append([0, figures.nice_axis(float(top))[0]])
+    return {'version': dataset.version,
+            'x': x, 'y': y, 'title': title,
+            'dates': np.datetime_as_string(cube.dates, unit='D').tolist(),
+            'states': states,
+            'names': [name if isinstance(name, str) else state
+                      for state, name in zip(states, names)],
+            'colors': [figures.COLORS[i % len(figures.COLORS)] for i in range(len(states))],
+            'range_x': ranges[0], 'range_y': ranges[1],
+            'chunk_days': CHUNK_DAYS,
+            'template': figures.get_template()}
+
+
+def animation_chunk(dataset, x, y, index):
+    '''Frames index * CHUNK_DAYS onwards, the rows of both metrics as
+    base64 float32 arrays of (date, state) in row-major order'''
+    start = index * CHUNK_DAYS
+    rows = slice(start, start + CHUNK_DAYS)
+    x_values = dataset.cube.metric(x)[rows]
+    y_values = dataset.cube.metric(y)[rows]
+    return {'version': dataset.version, 'index': index, 'start': start,
+            'count': len(x_values),
+            'x': figures.encode_array(x_values.ravel()),
+            'y': figures.encode_array(y_values.ravel())}
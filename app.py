@@ -1,16 +1,46 @@
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-import plotly.express as px
+from flask_compress import Compress
+import numpy as np
 import pandas as pd
-from dash.dependencies import Input, Output
-import plotly.graph_objs as go
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
 from plotly.subplots import make_subplots
 
+import animation
+import choropleth
+from ctp_data import dataset_version, get_dataset, load_data
+import downsample
+import figures
+from fig_cache import FigureCache, figure_key, figure_size
+import instrumentation
+import ranking
+from refresher import start_refresher
+
+logging.basicConfig(level=os.environ.get('CTP_LOG_LEVEL', 'INFO'),
+                    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
-app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
+app = dash.Dash(__name__, external_stylesheets=external_stylesheets, compress=False)
 server = app.server
+# Compressed here rather than by Dash, which would only enable gzip. Brotli
+# for the browsers that accept it, gzip for the rest
+server.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+Compress(server)
+instrumentation.add_metrics_route(server)
+
+# With CTP_CLIENTSIDE=1 the browser gets every state's series once and
+# builds the View 1 and View 3 figures itself, see update_series_store
+CLIENTSIDE = os.environ.get('CTP_CLIENTSIDE', '0') == '1'
+# Otherwise the server sends those figures, binary encoded by default
+BINARY_FIGURES = figures.ENCODING == 'binary' and not CLIENTSIDE
 
 
 state_rules = {'NY': {'ReOpening': '20200528'},
@@ -25,58 +55,63 @@ colors = {
 }
 
 
-def get_CTP_and_Census_data():
-    URL = 'https://covidtracking.com/api/states/daily'
-    CTP_df = pd.read_json(URL, dtype={'date': 'int64'})
-    CTP_df['date_val'] = pd.to_datetime(CTP_df['date'], format='%Y%m%d')
-    CTP_df.sort_values(['state', 'date'], inplace=True)
-
-    for item in ['deathIncrease', 'positiveIncrease', 'totalTestResultsIncrease', 'hospitalizedIncrease', 'hospitalizedCurrently']:
-        CTP_df[item + '_7day'] = CTP_df.groupby(
-            'state')[item].rolling(7).mean().reset_index(0, drop=True)
-
-    census_pop = pd.read_csv('https://data.cdc.gov/api/views/b2jx-uyck/rows.csv',
-                             names=['pop_year', 'state', 'state_name', 'TopicType', 'TopicDesc', 'DataSource', 'Data_Value_Type', 'Population', 'Gender', 'Age',
-                                    'GeoLocation', 'Source_File_USCB', 'Data_Pulled', 'LocationID', 'TopicTypeId', 'TopicId', 'MeasureId', 'StratificationID1',
-                                    'StratificationID2', 'SubMeasureID', 'DisplayOrder'],
-                             usecols=['pop_year', 'state', 'state_name',
-                                      'Population', 'Gender', 'Age', 'GeoLocation'],
-                             skiprows=1)
-    max_year = census_pop.pop_year.max()
-    census_pop_latest = census_pop[(census_pop.Gender == 'Total') &
-                                   (census_pop.Age == 'Total') &
-                                   (census_pop.pop_year == max_year)]
-
-    df = pd.merge(CTP_df, census_pop_latest[[
-        'pop_year', 'state', 'state_name', 'Population', 'GeoLocation']], on='state', how='outer')
-    cols_to_per_million = ['positive', 'negative', 'pending',
-                           'hospitalizedCurrently', 'hospitalizedCumulative', 'inIcuCurrently',
-                           'inIcuCumulative', 'onVentilatorCurrently', 'onVentilatorCumulative',
-                           'death', 'hospitalized',
-                           'totalTestsViral', 'positiveTestsViral', 'negativeTestsViral',
-                           'positiveCasesViral', 'positiveIncrease', 'negativeIncrease',
-                           'totalTestResults', 'totalTestResultsIncrease',
-                           'deathIncrease', 'hospitalizedIncrease',
-                           'totalTestResultsIncrease_7day', 'positiveIncrease_7day',
-                           'deathIncrease_7day', 'hospitalizedIncrease_7day', 'hospitalizedCurrently_7day']
-    for col in cols_to_per_million:
-        df[col + '_permil'] = df[col] / (df['Population'] / 1000000)
-    return df
+# Figures driven by states-dropdown, all built by update_figures
+LINE_FIGURES = [
+    {'id': 'tests-7day', 'y': 'totalTestResultsIncrease_7day',
+     'title': 'New Tests (7 day average)'},
+    {'id': 'tests-7day_permil', 'y': 'totalTestResultsIncrease_7day_permil',
+     'title': 'New Tests (7 day average  per million people)'},
+    {'id': 'cases-7day', 'y': 'positiveIncrease_7day',
+     'title': 'New Cases (7 day average)'},
+    {'id': 'cases-7day-permil', 'y': 'positiveIncrease_7day_permil',
+     'title': 'New Cases (7 day average per million people)'},
+    {'id': 'cur_hosp-7day', 'y': 'hospitalizedCurrently_7day',
+     'title': 'Currently Hospitalized (7 day average)'},
+    {'id': 'cur_hosp-7day_permil', 'y': 'hospitalizedCurrently_7day_permil',
+     'title': 'Currently Hospitalized (7 day average per million people)'},
+    {'id': 'deaths-7day', 'y': 'deathIncrease_7day',
+     'title': 'Deaths (7 day average)'},
+    {'id': 'deaths-7day_permil', 'y': 'deathIncrease_7day_permil',
+     'title': 'Deaths (7 day average per million people)'},
+]
+FACET_FIGURES = [
+    {'id': 'states_permil3-1', 'y': 'totalTestResultsIncrease_7day_permil',
+     'title': 'Tests - per million'},
+    {'id': 'states_permil3-2', 'y': 'positiveIncrease_7day_permil',
+     'title': 'Cases - per million'},
+    {'id': 'states_permil3-3', 'y': 'hospitalizedCurrently_7day_permil',
+     'title': 'Hospitalized - per million'},
+    {'id': 'states_permil3-4', 'y': 'deathIncrease_7day_permil',
+     'title': 'Deaths - per million'},
+]
+STATE_TABS = [
+    {'id': 'tab2',
+     'measure1': 'totalTestResultsIncrease_7day_permil', 'measure1_name': 'Tests (7day per mil)',
+     'measure2': 'positiveIncrease_7day_permil', 'measure2_name': 'Cases (7day per mil'},
+    {'id': 'tab4',
+     'measure1': 'deathIncrease_7day_permil', 'measure1_name': 'Deaths (7day per mil)',
+     'measure2': 'positiveIncrease_7day_permil', 'measure2_name': 'Cases (7day per mil)'},
+]
+# The animated scatter of the animation tab, see animation.py
+ANIMATION = {'id': 'animation', 'x': 'totalTestResultsIncrease_7day', 'y': 'positiveIncrease_7day',
+             'title': 'Tests vs Cases (7 day average)'}
+ANIMATION_FRAME_MS = 250
+# States listed by the leaderboard tab, and plotted by its "Plot top N"
+LEADERBOARD_N = 10
+# The graphs on each tab of tabs-example, only the open tab's are built
+VIEW_TABS = {'view1': LINE_FIGURES, 'view3': FACET_FIGURES}
+DEFAULT_TAB = 'view1'
 
 
 def get_state_options():
-    state_options = []
-    for index, row in df[['state', 'state_name']].drop_duplicates().fillna('NaN').iterrows():
-        # print(row['state'], row['state_name'])
-        if (row['state_name'] != 'NaN'):
-            state_options.append(
-                {'label': row['state_name'], 'value': row['state']})
-    return state_options
+    return get_dataset().dropdown['options']
 
 
-df = get_CTP_and_Census_data()
+load_data()
 
 state_options = get_state_options()
+default_states = get_dataset().dropdown['default']
+
 app.layout = html.Div([
     html.H1(children='The Covid Tracking Project - in Dash',
             style={'backgroundColor': colors['background'], 'textAlign': 'center',
@@ -84,12 +119,20 @@ app.layout = html.Div([
                    }),
     dcc.Dropdown(id='states-dropdown',
                  options=state_options,
-                 value=[
-                     'FL', 'NY', 'AZ', 'TX'],
+                 value=default_states,
                  multi=True
                  ),
-    dcc.Tabs(id='tabs-example', children=[
-        dcc.Tab(label='View 1', children=html.Div(
+    dcc.Location(id='url', refresh=False),
+    dcc.Store(id='viewport'),
+    # The series the figures are built from in the browser, or the encoded
+    # figures decoded into the graphs there
+    html.Div([dcc.Store(id='series-store')] if CLIENTSIDE else
+             [dcc.Store(id=spec['id'] + '-data') for spec in LINE_FIGURES + FACET_FIGURES]
+             if BINARY_FIGURES else []),
+    # What each tab's figures were last built for, see renderedKey
+    dcc.Store(id='rendered-tabs', data={}),
+    dcc.Tabs(id='tabs-example', value=DEFAULT_TAB, children=[
+        dcc.Tab(label='View 1', value='view1', children=html.Div(
             children=[
                 html.Div([
                     dcc.Graph(
@@ -126,9 +169,9 @@ app.layout = html.Div([
 
 
             ])),
-        dcc.Tab(id='tab2', label='Tests vs Cases'),
-        dcc.Tab(id='tab4', label='Cases vs Deaths'),
-        dcc.Tab(label='View 3', children=html.Div([
+        dcc.Tab(id='tab2', label='Tests vs Cases', value='tab2'),
+        dcc.Tab(id='tab4', label='Cases vs Deaths', value='tab4'),
+        dcc.Tab(label='View 3', value='view3', children=html.Div([
             html.Div([
                 dcc.Graph(
                     id='states_permil3-1')
@@ -146,245 +189,530 @@ app.layout = html.Div([
                     id='states_permil3-4')
             ]),
         ])),
+        dcc.Tab(label='Tests vs Cases animation', value='animation', children=html.Div([
+            dcc.Graph(id='animation-graph', animate=True),
+            html.Div([
+                html.Button('Play', id='animation-play'),
+                html.Div([
+                    dcc.Slider(id='animation-slider', min=0, max=0, step=1, value=0)
+                ], style={'display': 'inline-block', 'width': '90%'}),
+            ]),
+            dcc.Interval(id='animation-interval', interval=ANIMATION_FRAME_MS, disabled=True),
+            dcc.Store(id='animation-base'),
+            dcc.Store(id='animation-chunk-index'),
+            dcc.Store(id='animation-chunk'),
+        ])),
+        dcc.Tab(label='Leaderboard', value='leaderboard', children=html.Div([
+            html.Div([
+                dcc.Dropdown(id='leaderboard-metric',
+                             options=[{'label': name, 'value': name} for name in ranking.METRICS],
+                             value='positiveIncrease_7day_permil', clearable=False),
+            ], style={'display': 'inline-block', 'width': '40%'}),
+            dcc.RadioItems(id='leaderboard-stat',
+                           options=[{'label': label, 'value': stat}
+                                    for stat, label in ranking.STATS.items()],
+                           value='latest', labelStyle={'display': 'inline-block'},
+                           style={'display': 'inline-block', 'marginLeft': '20px'}),
+            # Range set by update_leaderboard_dates when the tab opens
+            dcc.Slider(id='leaderboard-date', min=0, max=0, step=1),
+            dcc.Store(id='leaderboard-version'),
+            html.Div([
+                dcc.Input(id='leaderboard-n', type='number', min=1, step=1,
+                          value=LEADERBOARD_N),
+                html.Button('Plot top N', id='leaderboard-plot'),
+            ]),
+            html.Div(id='leaderboard'),
+        ])),
+        dcc.Tab(label='Map', value='map', children=html.Div([
+            html.Div([
+                dcc.Dropdown(id='map-metric',
+                             options=[{'label': name, 'value': name} for name in choropleth.METRICS],
+                             value='positiveIncrease_7day_permil', clearable=False),
+            ], style={'width': '40%'}),
+            # Range set by update_map_dates from map-base
+            dcc.Slider(id='map-date', min=0, max=0, step=1),
+            dcc.Graph(id='map-graph'),
+            dcc.Store(id='map-base'),
+            dcc.Store(id='map-values'),
+        ])),
     ])
 ])
 
-print(len(app.layout))
+logger.debug('Layout has %d children', len(app.layout))
+
+# The browser window size, for sizing the downsampled figures
+app.clientside_callback(
+    'function(pathname) { return {width: window.innerWidth}; }',
+    Output('viewport', 'data'),
+    [Input('url', 'pathname')])
+
+
+def figureOutput(spec):
+    '''Where update_figures sends a figure, its graph or the Store it is decoded from'''
+    if BINARY_FIGURES:
+        return Output(spec['id'] + '-data', 'data')
+    return Output(spec['id'], 'figure')
+
+
+if BINARY_FIGURES:
+    for spec in LINE_FIGURES + FACET_FIGURES:
+        app.clientside_callback(
+            ClientsideFunction(namespace='ctp', function_name='decodeFigure'),
+            Output(spec['id'], 'figure'),
+            [Input(spec['id'] + '-data', 'data')])
 
 # Done - Specify multiple Outputs in callback - https://community.plotly.com/t/multiple-outputs-in-dash-now-available/19437
 
 
-def getStateFig(state, state_name, measure1, measure1_name, measure2, measure2_name):
-    df1 = df[df['state'] == state]
-
-    trace11 = go.Scatter(x=df1['date_val'],
-                         y=df1[measure1],
-                         name=measure1_name,
-                         yaxis='y1')
-    trace12 = go.Scatter(x=df1['date_val'],
-                         y=df1[measure2],
-                         name=measure2_name,
-                         yaxis='y2'
-                         )
-    data = [trace11, trace12]
-    state_annotations = []
-    for item in state_rules[state]:
-        print(state, item, state_rules[state][item])
-        anno = dict(
-            x=pd.to_datetime(
-                state_rules[state][item], format='%Y%m%d'),
-            y=31,
-            xref="x",
-            yref="y",
-            text=item,
-            showarrow=True,
-            ax=0,
-            ay=-300
-        )
-        state_annotations.append(anno)
-    print(state_annotations)
-    max1 = roundUp(df1[measure1].max())
-    max2 = roundUp(df1[measure2].max())
-    print("Hi1", measure1_name, measure1, max1, df1[measure1].max())
-    print("Hi2", measure2_name, measure2, max2)
-
-    layout = go.Layout(title=state_name,
-                       yaxis=dict(title=measure1_name,
-                                  range=[0, max1], dtick=300, autorange=False),
-                       yaxis2=dict(title=measure2_name,
-                                   overlaying='y',
-                                   side='right',
-                                   range=[0, max2], dtick=50, autorange=False),
-                       annotations=state_annotations)
-    return go.Figure(data=data, layout=layout)
-
-
-@app.callback(
-    [Output('tab2', 'children')],
-    [Input('states-dropdown', 'value')])
-def update_output(value):
-    graphs = []
-    for item in value:
-        g1 = html.Div([
-            dcc.Graph(
-                id='states_permil2-1',
-                figure=getStateFig(item, item,
-                                   'totalTestResultsIncrease_7day_permil', 'Tests (7day per mil)',
-                                   'positiveIncrease_7day_permil', 'Cases (7day per mil'))
-        ], style={'height': '400'},)
-        graphs.append(g1)
-    return [graphs]
+def getStateFig(dataset, state, state_name, measure1, measure1_name, measure2, measure2_name):
+    with instrumentation.phase('filter'):
+        dates, values1 = dataset.state_series(state, measure1)
+        dates, values2 = dataset.state_series(state, measure2)
+    axes = getStateAxes(dataset)
+    max1, dtick1 = axes[measure1].get(state, figures.nice_axis(0))
+    max2, dtick2 = axes[measure2].get(state, figures.nice_axis(0))
+
+    data = [{'type': 'scatter', 'x': dates, 'y': figures.json_floats(values1),
+             'name': measure1_name, 'yaxis': 'y'},
+            {'type': 'scatter', 'x': dates, 'y': figures.json_floats(values2),
+             'name': measure2_name, 'yaxis': 'y2'}]
+    layout = {'template': figures.get_template(),
+              'title': {'text': state_name},
+              'yaxis': {'title': {'text': measure1_name},
+                        'range': [0, max1], 'dtick': dtick1, 'autorange': False},
+              'yaxis2': {'title': {'text': measure2_name},
+                         'overlaying': 'y',
+                         'side': 'right',
+                         'range': [0, max2], 'dtick': dtick2, 'autorange': False},
+              'annotations': STATE_ANNOTATIONS.get(state, [])}
+    return {'data': data, 'layout': layout}
+
+
+# Parsed once, the annotations marking each state's rule changes
+STATE_ANNOTATIONS = {
+    state: [dict(x=pd.to_datetime(date, format='%Y%m%d'),
+                 y=31,
+                 xref="x",
+                 yref="y",
+                 text=item,
+                 showarrow=True,
+                 ax=0,
+                 ay=-300)
+            for item, date in rules.items()]
+    for state, rules in state_rules.items()}
+
+_state_axes = (None, None)
+
+
+def getStateAxes(dataset):
+    '''{measure: {state: (axis upper bound, tick step)}} for the STATE_TABS
+    measures, computed once per data version'''
+    global _state_axes
+    version, axes = _state_axes
+    if version != dataset.version:
+        measures = {spec[key] for spec in STATE_TABS for key in ('measure1', 'measure2')}
+        axes = {measure: {state: figures.nice_axis(value)
+                          for state, value in dataset.state_max(measure).items()}
+                for measure in measures}
+        _state_axes = (dataset.version, axes)
+    return axes
+
+
+getStateAxes(get_dataset())
+
+
+# Widths the figures are drawn at: View 1 graphs take 49% of the window,
+# facet figures are 800px wide
+DEFAULT_VIEWPORT_WIDTH = 1200
+LINE_FIGURE_WIDTH = 0.49
+FACET_FIGURE_WIDTH = 800
+
+figure_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('CTP_FIGURE_THREADS', 4)))
+figure_cache = FigureCache(
+    max_bytes=int(os.environ.get('CTP_FIGURE_CACHE_BYTES', 64 * 1024 * 1024)),
+    ttl=int(os.environ.get('CTP_FIGURE_CACHE_TTL', 3600)))
+
+instrumentation.Gauge('ctp_figure_cache_entries', 'Figures in the figure cache',
+                      lambda: {(): figure_cache.stats()['entries']})
+instrumentation.Gauge('ctp_figure_cache_bytes', 'Serialized size of the cached figures',
+                      lambda: {(): figure_cache.stats()['bytes']})
+instrumentation.Gauge('ctp_figure_cache_lookups_total', 'Figure cache lookups by result',
+                      lambda: {('hit',): figure_cache.stats()['hits'],
+                               ('miss',): figure_cache.stats()['misses']},
+                      ['result'], kind='counter')
+instrumentation.Gauge('ctp_dataset_rows', 'Rows in the live dataset',
+                      lambda: {(): len(get_dataset().df)})
+
+
+def getLineFig(dataset, states, spec, points=None):
+    figure = figures.line_figure(dataset, states, spec['y'], spec['title'], points=points)
+    return finishFigure(dataset, states, figure)
+
+
+def getFacetFig(dataset, states, spec, points=None):
+    figure = figures.facet_line_figure(dataset, states, spec['y'], spec['title'],
+                                       wrap=4, width=FACET_FIGURE_WIDTH, points=points)
+    return finishFigure(dataset, states, figure)
+
+
+def finishFigure(dataset, states, figure):
+    '''Set uirevision, keeping the user's zoom when the figure is swapped for
+    one of the same states, and encode the arrays in binary mode'''
+    figure['layout']['uirevision'] = ','.join(dataset.ordered_states(states))
+    if figures.ENCODING == 'binary':
+        figure = figures.encode_arrays(figure)
+    return figure
+
+
+def linePoints(states, viewport):
+    width = (viewport or {}).get('width') or DEFAULT_VIEWPORT_WIDTH
+    return downsample.points_for_width(width * LINE_FIGURE_WIDTH)
+
+
+def facetPoints(states, viewport):
+    return downsample.points_for_width(FACET_FIGURE_WIDTH / max(1, min(len(states or []), 4)))
+
+
+GRAPH_FIGURES = ([(spec, getLineFig, linePoints) for spec in LINE_FIGURES] +
+                 [(spec, getFacetFig, facetPoints) for spec in FACET_FIGURES])
 
 
-@app.callback(
-    [Output('tab4', 'children')],
-    [Input('states-dropdown', 'value')])
-def update_output(value):
+def getStateGraphs(dataset, states, spec):
     graphs = []
-    for item in value:
+    for item in states:
+        key = figure_key(spec['id'], [item], dataset.version)
+        figure = figure_cache.get(key)
+        if figure is None:
+            figure = buildAndCache(key, getStateFig, dataset, item, item,
+                                   spec['measure1'], spec['measure1_name'],
+                                   spec['measure2'], spec['measure2_name'])
         g1 = html.Div([
             dcc.Graph(
                 id='states_permil2-1',
-                figure=getStateFig(item, item,
-                                   'deathIncrease_7day_permil', 'Deaths (7day per mil)',
-                                   'positiveIncrease_7day_permil', 'Cases (7day per mil)'))
+                figure=figure)
         ], style={'height': '400'},)
         graphs.append(g1)
-    return [graphs]
-
-
-def roundUp(n):  # ToDo - use roundUP to check for max axis values
-    '''Round up to set axis upper limit'''
-    n1 = 10 ** (len(str(int(n))) - 2)
-    if n < 10:
-        return (int(n+0.99))
-    return int(n / n1 + 1) * n1
-
-
-@ app.callback(
-    dash.dependencies.Output('states_permil3-1', 'figure'),
-    [dash.dependencies.Input('states-dropdown', 'value')])
-def update_output(value):
-    df3 = df[df['state'].isin(value)]
-    fig4 = px.line(df3,
-                   x="date_val", y='totalTestResultsIncrease_7day_permil',
-                   facet_col='state', facet_col_wrap=4,
-                   width=800,
-                   hover_name="state", title='Tests - per million', color='state')
-    return fig4
-
-
-@ app.callback(
-    dash.dependencies.Output('states_permil3-2', 'figure'),
-    [dash.dependencies.Input('states-dropdown', 'value')])
-def update_output(value):
-    df3 = df[df['state'].isin(value)]
-    fig4 = px.line(df3,
-                   x="date_val", y='positiveIncrease_7day_permil',
-                   facet_col='state', facet_col_wrap=4,
-                   width=800,
-                   hover_name="state", title='Cases - per million', color='state')
-    return fig4
-
-
-@ app.callback(
-    dash.dependencies.Output('states_permil3-3', 'figure'),
-    [dash.dependencies.Input('states-dropdown', 'value')])
-def update_output(value):
-    df3 = df[df['state'].isin(value)]
-    fig4 = px.line(df3,
-                   x="date_val", y='hospitalizedCurrently_7day_permil',
-                   facet_col='state', facet_col_wrap=4,
-                   width=800,
-                   hover_name="state", title='Hospitalized - per million', color='state')
-    return fig4
-
-
-@ app.callback(
-    dash.dependencies.Output('states_permil3-4', 'figure'),
-    [dash.dependencies.Input('states-dropdown', 'value')])
-def update_output(value):
-    df3 = df[df['state'].isin(value)]
-    fig4 = px.line(df3,
-                   x="date_val", y='deathIncrease_7day_permil',
-                   facet_col='state', facet_col_wrap=4,
-                   width=800,
-                   hover_name="state", title='Deaths - per million', color='state')
-    return fig4
-
-
-@ app.callback(
-    dash.dependencies.Output('cases-7day', 'figure'),
-    [dash.dependencies.Input('states-dropdown', 'value')])
-def update_output(value):
-    df3 = df[df['state'].isin(value)]
-    fig4 = px.line(df3,
-                   x="date_val", y='positiveIncrease_7day',
-                   hover_name="state", title='New Cases (7 day average)', color='state')
-    return fig4
-
-
-@ app.callback(
-    dash.dependencies.Output('cases-7day-permil', 'figure'),
-    [dash.dependencies.Input('states-dropdown', 'value')])
-def update_output(value):
-    df3 = df[df['state'].isin(value)]
-    fig4 = px.line(df3, x="date_val", y='positiveIncrease_7day_permil',
-                   hover_name="state", title='New Cases (7 day average per million people)', color='state')
-    return fig4
-
-
-@ app.callback(
-    dash.dependencies.Output('tests-7day', 'figure'),
-    [dash.dependencies.Input('states-dropdown', 'value')])
-def update_output(value):
-    df3 = df[df['state'].isin(value)]
-    fig4 = px.line(df3, x="date_val", y='totalTestResultsIncrease_7day',
-                   hover_name="state",
-                   title='New Tests (7 day average)',
-                   color='state')
-    return fig4
-
-
-@ app.callback(
-    dash.dependencies.Output('tests-7day_permil', 'figure'),
-    [dash.dependencies.Input('states-dropdown', 'value')])
-def update_output(value):
-    df3 = df[df['state'].isin(value)]
-    fig4 = px.line(df3, x="date_val", y='totalTestResultsIncrease_7day_permil',
-                   hover_name="state",
-                   title='New Tests (7 day average  per million people)',
-                   color='state')
-    return fig4
-
-
-@ app.callback(
-    dash.dependencies.Output('cur_hosp-7day', 'figure'),
-    [dash.dependencies.Input('states-dropdown', 'value')])
-def update_output(value):
-    df3 = df[df['state'].isin(value)]
-    fig4 = px.line(df3, x="date_val", y='hospitalizedCurrently_7day',
-                   hover_name="state",
-                   title='Currently Hospitalized (7 day average)',
-                   color='state')
-    return fig4
-
-
-@ app.callback(
-    dash.dependencies.Output('cur_hosp-7day_permil', 'figure'),
-    [dash.dependencies.Input('states-dropdown', 'value')])
-def update_output(value):
-    df3 = df[df['state'].isin(value)]
-    fig4 = px.line(df3, x="date_val", y='hospitalizedCurrently_7day_permil',
-                   hover_name="state",
-                   title='Currently Hospitalized (7 day average per million people)',
-                   color='state')
-    return fig4
-
-
-@ app.callback(
-    dash.dependencies.Output('deaths-7day', 'figure'),
-    [dash.dependencies.Input('states-dropdown', 'value')])
-def update_output(value):
-    df3 = df[df['state'].isin(value)]
-    fig4 = px.line(df3, x="date_val", y='deathIncrease_7day',
-                   hover_name="state",
-                   title='Deaths (7 day average)',
-                   color='state')
-    return fig4
-
-
-@ app.callback(
-    dash.dependencies.Output('deaths-7day_permil', 'figure'),
-    [dash.dependencies.Input('states-dropdown', 'value')])
-def update_output(value):
-    df3 = df[df['state'].isin(value)]
-    fig4 = px.line(df3, x="date_val", y='deathIncrease_7day_permil',
-                   hover_name="state",
-                   title='Deaths (7 day average per million people)',
-                   color='state')
-    return fig4
+    return graphs
+
+
+def renderedKey(dataset, states, viewport):
+    '''What a tab's figures depend on, recorded in rendered-tabs when built'''
+    width = (viewport or {}).get('width') or DEFAULT_VIEWPORT_WIDTH
+    return '%s|%s|%s' % (dataset.version, ','.join(dataset.ordered_states(states)), width)
+
+
+def openTab(dataset, states, viewport, tab, rendered):
+    '''The open tab and rendered-tabs updated for it, PreventUpdate when the
+    tab already shows figures of the same states'''
+    tab = tab or DEFAULT_TAB
+    # Only the View 1 figures are sized to the window
+    key = renderedKey(dataset, states, viewport if tab == 'view1' else None)
+    if (rendered or {}).get(tab) == key:
+        raise PreventUpdate
+    return tab, dict(rendered or {}, **{tab: key})
+
+
+@instrumentation.instrument_callback(states_arg=0)
+def update_figures(value, viewport, tab, *relayouts_and_rendered):
+    '''Build the dropdown driven outputs of the open tab in one round trip.
+
+    The other tabs keep what they show until they are opened, rendered-tabs
+    records what each tab was built for so reopening an up to date tab
+    costs nothing. Figures come from figure_cache when possible, the misses
+    are built concurrently on figure_pool from the per-state slices of the
+    dataset. Series are downsampled to the width of their graph, zooming
+    into a graph reloads just that figure at full resolution.
+    '''
+    relayouts, rendered = relayouts_and_rendered[:-1], relayouts_and_rendered[-1]
+    dataset = get_dataset()
+    figure_cache.check_version(dataset.version)
+    triggered = [item['prop_id'] for item in dash.callback_context.triggered]
+    if triggered and all(prop.endswith('.relayoutData') for prop in triggered):
+        zoomed = {prop.split('.')[0] for prop in triggered}
+        jobs = []
+        for (spec, build, points), relayout in zip(GRAPH_FIGURES, relayouts):
+            if spec['id'] in zoomed and any('.range' in key for key in relayout or {}):
+                jobs.append(getFigure(dataset, value, spec, build, None))
+            else:
+                jobs.append(dash.no_update)
+        if all(job is dash.no_update for job in jobs):
+            raise PreventUpdate
+        jobs += [dash.no_update] * (len(STATE_TABS) + 1)
+    else:
+        tab, rendered = openTab(dataset, value, viewport, tab, rendered)
+        graphs = VIEW_TABS.get(tab, [])
+        jobs = [getFigure(dataset, value, spec, build, points(value, viewport))
+                if spec in graphs else dash.no_update
+                for spec, build, points in GRAPH_FIGURES]
+        jobs += [getStateGraphs(dataset, value, spec) if spec['id'] == tab else dash.no_update
+                 for spec in STATE_TABS]
+        jobs.append(rendered)
+    return [job.result() if isinstance(job, Future) else job for job in jobs]
+
+
+@instrumentation.instrument_callback(states_arg=0)
+def update_state_tabs(value, tab, rendered):
+    '''The per-state tab when open, the only dropdown driven outputs built
+    on the server in clientside mode'''
+    dataset = get_dataset()
+    figure_cache.check_version(dataset.version)
+    if tab not in [spec['id'] for spec in STATE_TABS]:
+        raise PreventUpdate
+    tab, rendered = openTab(dataset, value, None, tab, rendered)
+    return [getStateGraphs(dataset, value, spec) if spec['id'] == tab else dash.no_update
+            for spec in STATE_TABS] + [rendered]
+
+
+@instrumentation.instrument_callback
+def update_series_store(pathname):
+    '''Every state's series of the plotted metrics, sent once per page load'''
+    dataset = get_dataset()
+    figure_cache.check_version(dataset.version)
+    return figure_cache.get_or_build(figure_key('series-store', [], dataset.version),
+                                     getSeriesStore, dataset)
+
+
+def getSeriesStore(dataset):
+    '''The data and settings ctp.buildFigures in assets/figures.js builds from'''
+    specs = [dict(spec, facet=build is getFacetFig, wrap=4, width=FACET_FIGURE_WIDTH)
+             for spec, build, points in GRAPH_FIGURES]
+    return {'version': dataset.version,
+            'config': figures.client_config(),
+            'figures': specs,
+            'series': figures.encode_series(dataset, sorted({spec['y'] for spec in specs}))}
+
+
+if CLIENTSIDE:
+    app.callback(Output('series-store', 'data'),
+                 [Input('url', 'pathname')])(update_series_store)
+    app.clientside_callback(
+        ClientsideFunction(namespace='ctp', function_name='buildFigures'),
+        [Output(spec['id'], 'figure') for spec, build, points in GRAPH_FIGURES],
+        [Input('states-dropdown', 'value'), Input('series-store', 'data')])
+    app.callback([Output(spec['id'], 'children') for spec in STATE_TABS] +
+                 [Output('rendered-tabs', 'data')],
+                 [Input('states-dropdown', 'value'), Input('tabs-example', 'value')],
+                 [State('rendered-tabs', 'data')])(update_state_tabs)
+else:
+    app.callback(
+        [figureOutput(spec) for spec, build, points in GRAPH_FIGURES] +
+        [Output(spec['id'], 'children') for spec in STATE_TABS] +
+        [Output('rendered-tabs', 'data')],
+        [Input('states-dropdown', 'value'), Input('viewport', 'data'),
+         Input('tabs-example', 'value')] +
+        [Input(spec['id'], 'relayoutData') for spec, build, points in GRAPH_FIGURES],
+        [State('rendered-tabs', 'data')])(update_figures)
+
+
+@instrumentation.instrument_callback
+def update_animation_base(tab, base):
+    '''The animation's dates, states and axes, sent when the animation tab is
+    opened and the browser has none for the current data version'''
+    dataset = get_dataset()
+    figure_cache.check_version(dataset.version)
+    if tab != ANIMATION['id'] or (base or {}).get('version') == dataset.version:
+        raise PreventUpdate
+    key = figure_key(ANIMATION['id'] + '-base', [], dataset.version)
+    base = figure_cache.get(key) or buildAndCache(
+        key, animation.animation_base, dataset, ANIMATION['x'], ANIMATION['y'], ANIMATION['title'])
+    marks = {i: date[:7] for i, date in enumerate(base['dates']) if date.endswith('-01')}
+    return base, len(base['dates']) - 1, marks
+
+
+@instrumentation.instrument_callback
+def update_animation_chunk(index, base):
+    '''The animation frames of chunk index, see animation.animation_chunk.
+
+    The frames are of the data version of the browser's animation-base,
+    which a refresh may have replaced since.
+    '''
+    figure_cache.check_version(get_dataset().version)
+    dataset = dataset_version((base or {}).get('version'))
+    if index is None or not 0 <= index < animation.chunk_count(dataset):
+        raise PreventUpdate
+    key = figure_key(ANIMATION['id'] + '-chunk', [], dataset.version, index)
+    return figure_cache.get(key) or buildAndCache(
+        key, animation.animation_chunk, dataset, ANIMATION['x'], ANIMATION['y'], index)
+
+
+app.callback([Output('animation-base', 'data'), Output('animation-slider', 'max'),
+              Output('animation-slider', 'marks')],
+             [Input('tabs-example', 'value')],
+             [State('animation-base', 'data')])(update_animation_base)
+app.callback(Output('animation-chunk', 'data'),
+             [Input('animation-chunk-index', 'data')],
+             [State('animation-base', 'data')])(update_animation_chunk)
+app.clientside_callback(
+    ClientsideFunction(namespace='ctp', function_name='animationWanted'),
+    Output('animation-chunk-index', 'data'),
+    [Input('animation-slider', 'value'), Input('animation-base', 'data')],
+    # Only read, as an Input it would close a loop through update_animation_chunk
+    [State('animation-chunk', 'data')])
+app.clientside_callback(
+    ClientsideFunction(namespace='ctp', function_name='animationFigure'),
+    Output('animation-graph', 'figure'),
+    [Input('animation-slider', 'value'), Input('animation-chunk', 'data')],
+    [State('animation-base', 'data')])
+app.clientside_callback(
+    ClientsideFunction(namespace='ctp', function_name='animationTick'),
+    Output('animation-slider', 'value'),
+    [Input('animation-interval', 'n_intervals')],
+    [State('animation-slider', 'value'), State('animation-slider', 'max')])
+app.clientside_callback(
+    ClientsideFunction(namespace='ctp', function_name='togglePlay'),
+    [Output('animation-interval', 'disabled'), Output('animation-play', 'children')],
+    [Input('animation-play', 'n_clicks')],
+    [State('animation-interval', 'disabled')])
+
+
+@instrumentation.instrument_callback
+def update_leaderboard(tab, metric, stat, date_index, n):
+    '''The states ranked on a date, when the leaderboard tab is open'''
+    if tab != 'leaderboard':
+        raise PreventUpdate
+    dataset = get_dataset()
+    date_index = sliderDate(dataset, date_index)
+    names = dataset.states['state_name'].dropna()
+    top = dataset.rankings.top(metric, stat, date_index, leaderboardN(n))
+    rows = [html.Tr([html.Td(rank), html.Td(state), html.Td(names.get(state, state)),
+                     html.Td('%.1f' % value)])
+            for rank, (state, value) in enumerate(top, 1)]
+    return [html.H4('%s, %s on %s' % (metric, ranking.STATS[stat],
+                                      str(dataset.cube.dates[date_index]))),
+            html.Table([html.Tr([html.Th('Rank'), html.Th('State'), html.Th('Name'),
+                                 html.Th(ranking.STATS[stat])])] + rows)]
+
+
+@instrumentation.instrument_callback
+def update_leaderboard_dates(tab, version, value, last):
+    '''The leaderboard-date range, set when the leaderboard tab is opened and
+    the slider has none for the current data version'''
+    dataset = get_dataset()
+    if tab != 'leaderboard' or version == dataset.version:
+        raise PreventUpdate
+    dates = np.datetime_as_string(dataset.cube.dates, unit='D').tolist()
+    return sliderRange(dates, value, last) + (dataset.version,)
+
+
+def sliderRange(dates, value, last):
+    '''(max, marks, value) of a date slider over dates. value, picked on a
+    slider ending at last, follows the latest date when it was on it'''
+    new_last = len(dates) - 1
+    if value is None or last is None or value >= last:
+        value = new_last
+    marks = {i: date[:7] for i, date in enumerate(dates) if date.endswith('-01')}
+    return new_last, marks, max(0, min(value, new_last))
+
+
+@instrumentation.instrument_callback
+def plot_top_states(n_clicks, metric, stat, date_index, n):
+    '''Select the top n states of the leaderboard and show them on View 1'''
+    if not n_clicks:
+        raise PreventUpdate
+    n = leaderboardN(n) or LEADERBOARD_N
+    dataset = get_dataset()
+    top = dataset.rankings.top(metric, stat, sliderDate(dataset, date_index), n)
+    if not top:
+        raise PreventUpdate
+    return [state for state, value in top], 'view1'
+
+
+def leaderboardN(n):
+    '''The leaderboard-n value as a whole number of states, None when unset.
+    PreventUpdate below 1, the browser lets any number be typed in'''
+    if n is None:
+        return None
+    if n < 1:
+        raise PreventUpdate
+    return int(n)
+
+
+@instrumentation.instrument_callback
+def update_map_base(tab, base):
+    '''The map's state locations, sent when the map tab is opened and the
+    browser has none for the current data version'''
+    dataset = get_dataset()
+    figure_cache.check_version(dataset.version)
+    if tab != 'map' or (base or {}).get('version') == dataset.version:
+        raise PreventUpdate
+    key = figure_key('map-base', [], dataset.version)
+    return figure_cache.get(key) or buildAndCache(key, choropleth.map_base, dataset)
+
+
+@instrumentation.instrument_callback
+def update_map_dates(base, value, last):
+    '''The map-date range, following the data version of map-base'''
+    if not base:
+        raise PreventUpdate
+    return sliderRange(base['dates'], value, last)
+
+
+@instrumentation.instrument_callback
+def update_map_values(tab, metric, date_index, base):
+    '''One date's values of the map metric, see choropleth.map_values. The
+    values are of the data version of the browser's map-base, which a refresh
+    may have replaced since'''
+    if tab != 'map':
+        raise PreventUpdate
+    dataset = dataset_version((base or {}).get('version'))
+    return choropleth.map_values(dataset, metric, sliderDate(dataset, date_index))
+
+
+def sliderDate(dataset, date_index):
+    '''A date slider value as a date row, the latest date when unset'''
+    last = len(dataset.cube.dates) - 1
+    return last if date_index is None else max(0, min(int(date_index), last))
+
+
+app.callback(Output('leaderboard', 'children'),
+             [Input('tabs-example', 'value'), Input('leaderboard-metric', 'value'),
+              Input('leaderboard-stat', 'value'), Input('leaderboard-date', 'value'),
+              Input('leaderboard-n', 'value')])(update_leaderboard)
+app.callback([Output('leaderboard-date', 'max'), Output('leaderboard-date', 'marks'),
+              Output('leaderboard-date', 'value'), Output('leaderboard-version', 'data')],
+             [Input('tabs-example', 'value')],
+             [State('leaderboard-version', 'data'), State('leaderboard-date', 'value'),
+              State('leaderboard-date', 'max')])(update_leaderboard_dates)
+app.callback(Output('map-base', 'data'),
+             [Input('tabs-example', 'value')],
+             [State('map-base', 'data')])(update_map_base)
+app.callback([Output('map-date', 'max'), Output('map-date', 'marks'), Output('map-date', 'value')],
+             [Input('map-base', 'data')],
+             [State('map-date', 'value'), State('map-date', 'max')])(update_map_dates)
+app.callback(Output('map-values', 'data'),
+             [Input('tabs-example', 'value'), Input('map-metric', 'value'),
+              Input('map-date', 'value')],
+             [State('map-base', 'data')])(update_map_values)
+app.clientside_callback(
+    ClientsideFunction(namespace='ctp', function_name='mapFigure'),
+    Output('map-graph', 'figure'),
+    [Input('map-values', 'data'), Input('map-base', 'data')])
+app.callback([Output('states-dropdown', 'value'), Output('tabs-example', 'value')],
+             [Input('leaderboard-plot', 'n_clicks')],
+             [State('leaderboard-metric', 'value'), State('leaderboard-stat', 'value'),
+              State('leaderboard-date', 'value'), State('leaderboard-n', 'value')])(plot_top_states)
+
+
+def getFigure(dataset, states, spec, build, points):
+    '''The cached figure, or a Future building it on figure_pool'''
+    key = figure_key(spec['id'], states, dataset.version, points)
+    figure = figure_cache.get(key)
+    if figure is None:
+        figure = figure_pool.submit(buildAndCache, key, build, dataset, states, spec, points)
+    return figure
+
+
+def buildAndCache(key, build, *args):
+    with instrumentation.span(key[0]):
+        figure = build(*args)
+    if hasattr(figure, 'to_plotly_json'):
+        figure = figure.to_plotly_json()
+    size = instrumentation.timed_serialize(key[0], figure_size, figure)
+    figure_cache.put(key, figure, size)
+    return figure
 
 
 if __name__ == '__main__':
+    start_refresher()
     app.run_server(debug=True)
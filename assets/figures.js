@@ -0,0 +1,319 @@
+// Decoding of the figures encoded by figures.encode_arrays, the clientside
+// builds of the dropdown figures (CTP_CLIENTSIDE mode), the playback of
+// the animation tab and the state map
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    ctp: {
+        decodeFigure: function(figure) {
+            if (!figure) {
+                return window.dash_clientside.no_update;
+            }
+            var data = figure.data.map(function(trace) {
+                var decoded = Object.assign({}, trace);
+                ['x', 'y'].forEach(function(key) {
+                    if (trace[key] && trace[key].b64 !== undefined) {
+                        decoded[key] = decodeArray(trace[key]);
+                    }
+                });
+                return decoded;
+            });
+            return Object.assign({}, figure, {data: data});
+        },
+
+        // The View 1 and View 3 figures for the selected states, built from
+        // the series store like figures.line_figure and
+        // figures.facet_line_figure build them on the server
+        buildFigures: function(states, store) {
+            if (!store) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            var series = decodedSeries(store);
+            var selected = store.series.order.filter(function(state) {
+                return (states || []).indexOf(state) >= 0;
+            });
+            return store.figures.map(function(spec) {
+                var figure = spec.facet ?
+                    facetLineFigure(store.config, series, selected, spec) :
+                    lineFigure(store.config, series, selected, spec);
+                figure.layout.uirevision = selected.join(',');
+                return figure;
+            });
+        },
+
+        // The animation chunk to fetch next: the one holding frame value,
+        // then the following one once value is past the middle of its chunk.
+        // Runs on slider moves and playback ticks, chunk is the last one
+        // received
+        animationWanted: function(value, base, chunk) {
+            if (!base) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            resetAnimation(base.version);
+            cacheChunk(chunk);
+            var days = base.chunk_days;
+            var index = Math.floor((value || 0) / days);
+            var wanted = [index];
+            if ((value || 0) % days >= days / 2 && (index + 1) * days < base.dates.length) {
+                wanted.push(index + 1);
+            }
+            for (var i = 0; i < wanted.length; i++) {
+                if (!animationCache.chunks[wanted[i]] && !animationCache.requested[wanted[i]]) {
+                    animationCache.requested[wanted[i]] = true;
+                    return wanted[i];
+                }
+            }
+            throw window.dash_clientside.PreventUpdate;
+        },
+
+        // The scatter of frame value, once its chunk has arrived
+        animationFigure: function(value, chunk, base) {
+            if (!base) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            resetAnimation(base.version);
+            cacheChunk(chunk);
+            value = value || 0;
+            var frames = animationCache.chunks[Math.floor(value / base.chunk_days)];
+            if (!frames) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            var n = base.states.length;
+            var row = value - frames.start;
+            return {
+                data: [{
+                    type: 'scatter',
+                    mode: 'markers+text',
+                    x: Array.from(frames.x.subarray(row * n, (row + 1) * n)),
+                    y: Array.from(frames.y.subarray(row * n, (row + 1) * n)),
+                    text: base.states,
+                    hovertext: base.names,
+                    textposition: 'top center',
+                    marker: {color: base.colors, size: 12},
+                    hovertemplate: '<b>%{hovertext}</b><br><br>' + base.x + '=%{x}<br>' +
+                        base.y + '=%{y}<extra></extra>'
+                }],
+                layout: {
+                    template: base.template,
+                    title: {text: base.title + ' - ' + base.dates[value]},
+                    xaxis: {title: {text: base.x}, range: base.range_x},
+                    yaxis: {title: {text: base.y}, range: base.range_y},
+                    uirevision: base.version
+                }
+            };
+        },
+
+        // Advance the animation slider, from the last frame back to the first
+        animationTick: function(n_intervals, value, max) {
+            if (!n_intervals) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            return (value || 0) >= max ? 0 : (value || 0) + 1;
+        },
+
+        togglePlay: function(n_clicks, disabled) {
+            if (!n_clicks) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            return [!disabled, disabled ? 'Pause' : 'Play'];
+        },
+
+        // The state map of one date's values, on the locations of the base
+        mapFigure: function(values, base) {
+            if (!values || !base || values.version !== base.version) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            var z = Array.from(decodeArray(values.z));
+            return {
+                data: [{
+                    type: 'choropleth',
+                    locationmode: 'USA-states',
+                    locations: base.states,
+                    z: z,
+                    zmin: 0,
+                    zmax: values.zmax,
+                    colorscale: 'Reds',
+                    text: base.names,
+                    colorbar: {title: {text: 'per million'}},
+                    hovertemplate: '<b>%{text}</b><br>' + values.metric + '=%{z}<extra></extra>'
+                }, {
+                    type: 'scattergeo',
+                    locationmode: 'USA-states',
+                    lat: base.lat,
+                    lon: base.lon,
+                    text: base.states,
+                    mode: 'text',
+                    hoverinfo: 'skip',
+                    showlegend: false
+                }],
+                layout: {
+                    template: base.template,
+                    title: {text: values.metric + ' on ' + values.date},
+                    geo: {scope: 'usa'},
+                    height: 600,
+                    uirevision: 'map'
+                }
+            };
+        }
+    }
+});
+
+// Decoded animation chunks of one data version, by chunk index
+var animationCache = {version: null, chunks: {}, requested: {}};
+
+function resetAnimation(version) {
+    if (animationCache.version !== version) {
+        animationCache = {version: version, chunks: {}, requested: {}};
+    }
+}
+
+function cacheChunk(chunk) {
+    if (!chunk || animationCache.chunks[chunk.index]) {
+        return;
+    }
+    if (chunk.version !== animationCache.version) {
+        // A newer version answers a request of this one when its snapshot
+        // is gone from the server, the next move asks again. Older ones are
+        // left over from before the base changed.
+        if (chunk.version > animationCache.version) {
+            delete animationCache.requested[chunk.index];
+        }
+        return;
+    }
+    animationCache.chunks[chunk.index] = {
+        start: chunk.start, x: decodeArray(chunk.x), y: decodeArray(chunk.y)
+    };
+    delete animationCache.requested[chunk.index];
+}
+
+function decodeArray(array) {
+    var bytes = atob(array.b64);
+    var buffer = new Uint8Array(bytes.length);
+    for (var i = 0; i < bytes.length; i++) {
+        buffer[i] = bytes.charCodeAt(i);
+    }
+    if (array.dtype === 'days') {
+        // Milliseconds since the epoch, what date axes take as numbers
+        var days = new Int32Array(buffer.buffer);
+        var ms = new Float64Array(days.length);
+        for (var j = 0; j < days.length; j++) {
+            ms[j] = days[j] * 86400000;
+        }
+        return ms;
+    }
+    return new Float32Array(buffer.buffer);
+}
+
+// Series decoded once per data version
+var seriesCache = {version: null, states: null};
+
+function decodedSeries(store) {
+    if (seriesCache.version !== store.version) {
+        var states = {};
+        Object.keys(store.series.states).forEach(function(state) {
+            var columns = store.series.states[state];
+            states[state] = {};
+            Object.keys(columns).forEach(function(col) {
+                states[state][col] = decodeArray(columns[col]);
+            });
+        });
+        seriesCache = {version: store.version, states: states};
+    }
+    return seriesCache.states;
+}
+
+function lineTraces(config, series, states, y, axes) {
+    var points = 0;
+    states.forEach(function(state) {
+        points += series[state].days.length;
+    });
+    var type = (config.render_mode === 'webgl' ||
+                (config.render_mode === 'auto' && points > config.webgl_threshold)) ?
+        'scattergl' : 'scatter';
+    return states.map(function(state, i) {
+        var axis = axes ? axes[i] : '';
+        var trace = {
+            type: type,
+            mode: 'lines',
+            name: state,
+            legendgroup: state,
+            showlegend: true,
+            line: {color: config.colors[i % config.colors.length], dash: 'solid'},
+            hovertemplate: '<b>' + state + '</b><br><br>state=' + state +
+                '<br>date_val=%{x}<br>' + y + '=%{y}<extra></extra>',
+            x: series[state].days,
+            y: series[state][y],
+            xaxis: 'x' + axis,
+            yaxis: 'y' + axis
+        };
+        if (type === 'scatter') {
+            trace.orientation = 'v';
+        }
+        return trace;
+    });
+}
+
+function lineFigure(config, series, states, spec) {
+    return {
+        data: lineTraces(config, series, states, spec.y),
+        layout: {
+            template: config.template,
+            xaxis: {anchor: 'y', domain: [0, 1], title: {text: 'date_val'}, type: 'date'},
+            yaxis: {anchor: 'x', domain: [0, 1], title: {text: spec.y}},
+            legend: {title: {text: 'state'}, tracegroupgap: 0},
+            title: {text: spec.title}
+        }
+    };
+}
+
+function facetLineFigure(config, series, states, spec) {
+    var ncols = Math.max(1, Math.min(states.length, spec.wrap));
+    var nrows = Math.max(1, Math.ceil(states.length / ncols));
+    var colWidth = (1 - config.facet_col_spacing * (ncols - 1)) / ncols;
+    var rowHeight = (1 - config.facet_row_spacing * (nrows - 1)) / nrows;
+    var layout = {
+        template: config.template,
+        annotations: [],
+        legend: {title: {text: 'state'}, tracegroupgap: 0},
+        title: {text: spec.title},
+        width: spec.width
+    };
+    // Subplots are numbered from the bottom left, facets fill from the top left
+    for (var row = 0; row < nrows; row++) {
+        for (var col = 0; col < ncols; col++) {
+            var n = row * ncols + col + 1;
+            var suffix = n > 1 ? String(n) : '';
+            var xStart = col * (colWidth + config.facet_col_spacing);
+            var yStart = row * (rowHeight + config.facet_row_spacing);
+            var xaxis = {anchor: 'y' + suffix, domain: [xStart, xStart + colWidth], type: 'date'};
+            var yaxis = {anchor: 'x' + suffix, domain: [yStart, yStart + rowHeight]};
+            if (n > 1) {
+                xaxis.matches = 'x';
+                yaxis.matches = 'y';
+            }
+            if (row === 0) {
+                xaxis.title = {text: 'date_val'};
+            } else {
+                xaxis.showticklabels = false;
+            }
+            if (col === 0) {
+                yaxis.title = {text: spec.y};
+            } else {
+                yaxis.showticklabels = false;
+            }
+            layout['xaxis' + suffix] = xaxis;
+            layout['yaxis' + suffix] = yaxis;
+        }
+    }
+    var axes = states.map(function(state, i) {
+        var n = (nrows - 1 - Math.floor(i / ncols)) * ncols + i % ncols + 1;
+        return n > 1 ? String(n) : '';
+    });
+    states.forEach(function(state, i) {
+        var xDomain = layout['xaxis' + axes[i]].domain;
+        layout.annotations.push({
+            font: {}, showarrow: false, text: 'state=' + state,
+            x: (xDomain[0] + xDomain[1]) / 2, xanchor: 'center', xref: 'paper',
+            y: layout['yaxis' + axes[i]].domain[1], yanchor: 'bottom', yref: 'paper'
+        });
+    });
+    return {data: lineTraces(config, series, states, spec.y, axes), layout: layout};
+}
@@ -0,0 +1,57 @@
+'''Payload size and build time of the dropdown figures, by downsampling and encoding.
+
+    python bench_payload.py [--width 1920] [--states 4,16,56]
+
+Builds the View 1 and View 3 figures for the first N states of the current
+snapshot, as update_figures does on a cache miss, and reports their size
+raw and compressed as the server sends them.
+'''
+import argparse
+import gzip
+import json
+import time
+
+import brotli
+import plotly.utils
+
+import app
+import figures
+
+MODES = [('full json', False, 'json'),
+         ('json', True, 'json'),
+         ('binary', True, 'binary')]
+
+
+def measure(dataset, states, width, downsampled, encoding):
+    viewport = {'width': width}
+    figures.ENCODING = encoding
+    start = time.time()
+    payload = [build(dataset, states, spec, points(states, viewport) if downsampled else None)
+               for spec, build, points in app.GRAPH_FIGURES]
+    payload = json.dumps(payload, cls=plotly.utils.PlotlyJSONEncoder).encode()
+    return payload, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--width', type=int, default=1920, help='browser window width')
+    parser.add_argument('--states', default='4,16,56', help='state counts to measure')
+    args = parser.parse_args()
+
+    dataset = app.get_dataset()
+    all_states = [option['value'] for option in dataset.dropdown['options']]
+    days = len(dataset.state_series(all_states[0], 'date')[0])
+    print('%d days per state, %dpx window' % (days, args.width))
+    print('%6s %-10s %9s %9s %9s %6s' % ('states', 'mode', 'raw', 'gzip', 'brotli', 'build'))
+    for count in [int(count) for count in args.states.split(',')]:
+        states = all_states[:count]
+        for name, downsampled, encoding in MODES:
+            payload, seconds = measure(dataset, states, args.width, downsampled, encoding)
+            print('%6d %-10s %7.0fKB %7.0fKB %7.0fKB %5.2fs' % (
+                len(states), name, len(payload) / 1024.,
+                len(gzip.compress(payload, 6)) / 1024.,
+                len(brotli.compress(payload, quality=4)) / 1024., seconds))
+
+
+if __name__ == '__main__':
+    main()
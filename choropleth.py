@@ -0,0 +1,62 @@
+'''The US state map of a per-million metric on a date.
+
+The map is sent in two parts. map_base, sent once per data version, holds
+the state codes plotly's 'USA-states' geometry is looked up by, each
+state's GeoLocation centroid from the census table, where the state labels
+are drawn, and the dates the date slider ranges over. map_values holds one
+date's values of a metric, a base64 float32 vector in the order of
+map_base's states, so moving the date slider sends a few hundred bytes and
+never the geometry again. See ctp.mapFigure in assets/figures.js.
+'''
+import re
+
+import numpy as np
+
+import derived
+import figures
+
+METRICS = [name for name, metric in derived.METRICS.items()
+           if metric.kind == derived.PER_MILLION]
+
+_POINT = re.compile(r'\(\s*([-\d.]+)\s*,\s*([-\d.]+)\s*\)')
+
+
+def parse_geolocation(value):
+    '''(lat, lon) of a census GeoLocation like "(32.84, -86.63)", None if missing'''
+    match = _POINT.match(value) if isinstance(value, str) else None
+    if match is None:
+        return None
+    return float(match.group(1)), float(match.group(2))
+
+
+def map_states(dataset):
+    '''[(state, cube column, (lat, lon))] of the states with a GeoLocation'''
+    geolocations = dataset.states['GeoLocation'].reindex(dataset.cube.states)
+    located = [(state, j, parse_geolocation(value))
+               for j, (state, value) in enumerate(geolocations.items())]
+    return [item for item in located if item[2] is not None]
+
+
+def map_base(dataset):
+    located = map_states(dataset)
+    names = dataset.states['state_name'].reindex([state for state, j, point in located])
+    return {'version': dataset.version,
+            'states': [state for state, j, point in located],
+            'names': names.tolist(),
+            'lat': [point[0] for state, j, point in located],
+            'lon': [point[1] for state, j, point in located],
+            'dates': np.datetime_as_string(dataset.cube.dates, unit='D').tolist(),
+            'template': figures.get_template()}
+
+
+def map_values(dataset, metric, date_index):
+    '''The metric on date_index for the states of map_base, and the colour scale
+    maximum, the metric's highest value on any date so colours compare across dates'''
+    columns = [j for state, j, point in map_states(dataset)]
+    values = dataset.cube.metric(metric)
+    located = values[:, columns]
+    top = float(np.nanmax(located)) if np.isfinite(located).any() else 0.0
+    return {'version': dataset.version, 'metric': metric,
+            'date': str(dataset.cube.dates[date_index]),
+            'z': figures.encode_array(located[date_index]),
+            'zmax': figures.nice_axis(top)[0]}
@@ -0,0 +1,569 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+import cube
+import derived
+import fetch
+import json_stream
+import ranking
+
+CTP_URL = os.environ.get('CTP_URL', 'https://covidtracking.com/api/states/daily')
+CENSUS_URL = os.environ.get(
+    'CENSUS_URL', 'https://data.cdc.gov/api/views/b2jx-uyck/rows.csv')
+# Names of the downloaded sources in the snapshot's http_cache directory
+CTP_FILE = 'ctp.json'
+CENSUS_FILE = 'census.csv'
+# The census columns reduced to one row per state, see census_table
+CENSUS_TABLE = 'census.json'
+
+# Snapshots live in versioned sub directories, CURRENT names the live one
+SNAPSHOT_DIR = os.environ.get('CTP_SNAPSHOT_DIR', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'snapshot'))
+# Bumped whenever the files or meta.json layout save_snapshot writes change,
+# older snapshots are then rebuilt instead of being misread. Snapshots
+# labelled 1 or 2 were written while the category block, the lazily derived
+# metrics and the compact schema changed the layout under the same label.
+# 4 added the arrays Dataset derives from the frame, see dataset_arrays
+SNAPSHOT_FORMAT = 4
+KEEP_VERSIONS = 3
+
+
+CENSUS_COLS = ['pop_year', 'state', 'state_name', 'Population', 'GeoLocation']
+# Per-state columns kept in Dataset.states rather than repeated on every row
+STATE_COLS = ['state_name', 'Population', 'GeoLocation', 'pop_year']
+# Derived metrics stored in the snapshot, the ones the dashboard plots. All
+# other metrics in derived.METRICS are computed on demand by Dataset.column
+SNAPSHOT_METRICS = ['totalTestResultsIncrease_7day', 'positiveIncrease_7day',
+                    'hospitalizedCurrently_7day', 'deathIncrease_7day',
+                    'totalTestResultsIncrease_7day_permil', 'positiveIncrease_7day_permil',
+                    'hospitalizedCurrently_7day_permil', 'deathIncrease_7day_permil']
+
+# Metrics held in Dataset.cube, every base column and the stored metrics
+CUBE_METRICS = derived.BASE_COLS + SNAPSHOT_METRICS
+
+# The dropdown selection the dashboard opens with
+DEFAULT_STATES = ['FL', 'NY', 'AZ', 'TX']
+
+# Columns kept from the CTP feed and their dtypes, the rest are dropped
+CTP_SCHEMA = dict([('date', 'int32'), ('state', 'category')] +
+                  [(col, 'float32') for col in derived.BASE_COLS])
+# dtypes of the merged frame, date_val is derived from date
+FRAME_SCHEMA = dict(list(CTP_SCHEMA.items()) +
+                    [('date_val', 'datetime64[ns]'),
+                     ('Population', 'float64')] +
+                    [(col, 'float32') for col in SNAPSHOT_METRICS])
+
+
+def apply_schema(df, schema=FRAME_SCHEMA):
+    '''Return df reduced to the columns of schema, cast to their dtypes'''
+    return df.reindex(columns=list(schema)).astype(schema)
+
+
+def get_CTP_data(source=CTP_URL):
+    # Streamed straight into the schema's columns, the feed is never held
+    # in memory as a whole
+    with fetch.open_text(source) as f:
+        CTP_df = json_stream.read_frame(f, CTP_SCHEMA)
+    CTP_df['date_val'] = pd.to_datetime(CTP_df['date'], format='%Y%m%d')
+    CTP_df.sort_values(['state', 'date'], inplace=True)
+    return CTP_df
+
+
+def get_census_data(source=CENSUS_URL):
+    # Read in chunks, only the state totals are kept from each
+    chunks = pd.read_csv(source,
+                         names=['pop_year', 'state', 'state_name', 'TopicType', 'TopicDesc', 'DataSource', 'Data_Value_Type', 'Population', 'Gender', 'Age',
+                                'GeoLocation', 'Source_File_USCB', 'Data_Pulled', 'LocationID', 'TopicTypeId', 'TopicId', 'MeasureId', 'StratificationID1',
+                                'StratificationID2', 'SubMeasureID', 'DisplayOrder'],
+                         usecols=['pop_year', 'state', 'state_name',
+                                  'Population', 'Gender', 'Age', 'GeoLocation'],
+                         skiprows=1, chunksize=100000)
+    census_pop = pd.concat([chunk[(chunk.Gender == 'Total') & (chunk.Age == 'Total')]
+                            for chunk in chunks])
+    max_year = census_pop.pop_year.max()
+    census_pop_latest = census_pop[census_pop.pop_year == max_year]
+    return census_pop_latest[CENSUS_COLS]
+
+
+def census_table(census_source=CENSUS_URL, snapshot_dir=SNAPSHOT_DIR, changed=True):
+    '''The census columns per state, as a frame indexed by state.
+
+    Derived from census_source only when it changed or the table is missing,
+    otherwise loaded from the census.json saved next to the snapshots.
+    '''
+    path = os.path.join(snapshot_dir, CENSUS_TABLE)
+    if changed or not os.path.exists(path):
+        table = get_census_data(census_source).drop_duplicates('state')
+        os.makedirs(snapshot_dir, exist_ok=True)
+        table.set_index('state').to_json(path + '.tmp', orient='index')
+        os.replace(path + '.tmp', path)
+    with open(path) as f:
+        table = pd.DataFrame.from_dict(json.load(f), orient='index')
+    table.index.name = 'state'
+    return table
+
+
+def join_census(df, census):
+    '''Add the Population of each row's state from the census table to df.
+
+    Looked up once per state category and gathered to the rows by category
+    code, states missing from the census get NaN.
+    '''
+    state = df['state'].astype('category')
+    rows = census.index.get_indexer(state.cat.categories)
+    population = np.append(census['Population'].values.astype('float64'), np.nan)
+    # Index -1 (no census row, or no state) picks the trailing NaN
+    by_code = np.append(population[rows], np.nan)
+    df['Population'] = by_code[state.cat.codes.values]
+    return df
+
+
+def state_table(df, census):
+    '''The census columns for the states of df, indexed by state in category order'''
+    table = census.reindex(df['state'].cat.categories)
+    table.index.name = 'state'
+    return table.reindex(columns=STATE_COLS)
+
+
+def get_CTP_and_Census_data(ctp_source=CTP_URL, census=None):
+    if census is None:
+        census = get_census_data().drop_duplicates('state').set_index('state')
+    df = join_census(get_CTP_data(ctp_source), census)
+    df.reset_index(drop=True, inplace=True)
+    derived.add_metrics(df, SNAPSHOT_METRICS)
+    return apply_schema(df)
+
+
+def update_CTP_data(df, census, ctp_source=CTP_URL):
+    '''Return df extended with the CTP rows newer than its newest date.
+
+    Only the new rows are derived. Each state's last ROLLING_WINDOW - 1
+    loaded rows are carried along so the rolling means of the new rows see
+    a full window. Returns None when the feed has nothing new.
+    '''
+    latest = df['date'].max()
+    new_df = get_CTP_data(ctp_source)
+    new_df = new_df[new_df['date'] > latest]
+    if new_df.empty:
+        return None
+
+    lookback = df.groupby('state', observed=True).tail(derived.ROLLING_WINDOW - 1)
+    new_df = pd.concat(
+        [lookback.reindex(columns=new_df.columns), new_df], ignore_index=True)
+    new_df = join_census(new_df, census)
+    new_df.sort_values(['state', 'date'], inplace=True)
+    derived.add_metrics(new_df, SNAPSHOT_METRICS)
+    new_df = new_df[new_df['date'] > latest]
+
+    df = pd.concat([df, new_df.reindex(columns=df.columns)])
+    df.sort_values(['state', 'date'], kind='mergesort', inplace=True)
+    return apply_schema(df.reset_index(drop=True))
+
+
+def save_snapshot(df, snapshot_dir=SNAPSHOT_DIR, states=None):
+    '''Write df as a new snapshot version and make it the current one.
+
+    Columns are grouped by dtype into 2-D .npy blocks (one row per column).
+    String and categorical columns are stored as category codes, with the
+    categories kept in meta.json. The per-state table states (see
+    state_table) is kept in meta.json as well, the arrays a Dataset derives
+    from the frame are saved next to the blocks (see dataset_arrays).
+    '''
+    version = time.strftime('%Y%m%d%H%M%S') + '%06d' % (time.time() % 1 * 1e6)
+    path = os.path.join(snapshot_dir, version)
+    tmp_path = path + '.tmp'
+    os.makedirs(tmp_path)
+
+    blocks = {}
+    categories = {}
+    for col in df.columns:
+        values = df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype) or values.dtype == object:
+            if values.dtype == object:
+                values = values.where(values.isna(), values.astype(str))
+            values = pd.Categorical(values)
+            categories[col] = list(values.categories)
+            blocks.setdefault('category', []).append(
+                (col, values.codes.astype('int32')))
+        else:
+            blocks.setdefault(values.dtype.str, []).append((col, values.values))
+
+    meta = {'format': SNAPSHOT_FORMAT,
+            'version': version,
+            'rows': len(df),
+            'columns': list(df.columns),
+            'categories': categories,
+            'states': None if states is None else json.loads(states.to_json(orient='split')),
+            'dropdown': dropdown_metadata(df, states),
+            'blocks': []}
+    for i, (dtype, items) in enumerate(blocks.items()):
+        file_name = 'block%d.npy' % i
+        np.save(os.path.join(tmp_path, file_name),
+                np.stack([values for col, values in items]))
+        meta['blocks'].append({'file': file_name, 'dtype': dtype,
+                               'columns': [col for col, values in items]})
+    arrays, meta['arrays'] = dataset_arrays(Dataset(df, version, states, meta['dropdown']))
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), values)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    os.rename(tmp_path, path)
+    _write_current(snapshot_dir, version)
+    _prune_versions(snapshot_dir, version)
+    return version
+
+
+def dataset_arrays(dataset):
+    '''The arrays of dataset derived from its frame, and the meta.json entry
+    load_arrays rebuilds them from. Saved with the snapshot so that every
+    process maps them from the page cache rather than deriving its own copy.
+    '''
+    rank_keys = list(dataset.rankings.values)
+    arrays = {'dates': dataset.dates,
+              # The cube's metric-major storage, see cube.Cube
+              'cube': dataset.cube.values.transpose(2, 0, 1),
+              'cube_dates': dataset.cube.dates,
+              'population': dataset.cube.population,
+              'rank_values': np.stack([dataset.rankings.values[key] for key in rank_keys]),
+              'rank_orders': np.stack([dataset.rankings.orders[key] for key in rank_keys])}
+    meta = {'names': list(arrays),
+            'cube_states': dataset.cube.states,
+            'cube_metrics': dataset.cube.metrics,
+            'rank_keys': rank_keys}
+    return arrays, meta
+
+
+def load_arrays(path, meta, mmap=False):
+    '''The dates, cube and rankings saved by dataset_arrays, as Dataset takes them'''
+    entry = meta['arrays']
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None)
+              for name in entry['names']}
+    rank_keys = [tuple(key) for key in entry['rank_keys']]
+    return {'dates': arrays['dates'],
+            'cube': cube.Cube(arrays['cube_dates'], entry['cube_states'], entry['cube_metrics'],
+                              arrays['cube'].transpose(1, 2, 0), arrays['population']),
+            'rankings': ranking.Rankings(entry['cube_states'],
+                                         dict(zip(rank_keys, arrays['rank_values'])),
+                                         dict(zip(rank_keys, arrays['rank_orders'])))}
+
+
+def dropdown_metadata(df, states=None):
+    '''Options, default selection and per-state date ranges for the states dropdown.
+
+    Options are the states of df that have a name in the state table
+    states, in frame order. Date ranges are [first, last] YYYYMMDD dates.
+    df must be sorted by state and date.
+    '''
+    starts = derived.group_starts(df['state'].values)
+    stops = np.r_[starts[1:], len(df)] - 1
+    names = np.asarray(df['state'].values[starts], dtype=object)
+    dates = df['date'].values
+    labels = states['state_name'] if states is not None else pd.Series(dtype=object)
+    labels = labels.reindex(names).values
+    return {'options': [{'label': label, 'value': state}
+                        for state, label in zip(names, labels) if isinstance(label, str)],
+            'default': [state for state in DEFAULT_STATES if state in set(names)],
+            'date_ranges': {state: [int(first), int(last)]
+                            for state, first, last in zip(names, dates[starts], dates[stops])}}
+
+
+def _write_current(snapshot_dir, version):
+    tmp_file = os.path.join(snapshot_dir, 'CURRENT.tmp')
+    with open(tmp_file, 'w') as f:
+        f.write(version)
+    os.replace(tmp_file, os.path.join(snapshot_dir, 'CURRENT'))
+
+
+def _prune_versions(snapshot_dir, current):
+    versions = sorted(name for name in os.listdir(snapshot_dir)
+                      if os.path.isfile(os.path.join(snapshot_dir, name, 'meta.json')))
+    for name in versions[:-KEEP_VERSIONS]:
+        if name != current:
+            shutil.rmtree(os.path.join(snapshot_dir, name), ignore_errors=True)
+
+
+def current_version(snapshot_dir=SNAPSHOT_DIR):
+    '''Return the version name of the current snapshot, or None'''
+    try:
+        with open(os.path.join(snapshot_dir, 'CURRENT')) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def read_meta(snapshot_dir=SNAPSHOT_DIR, version=None):
+    '''meta.json of a snapshot version, by default the current one'''
+    version = version or current_version(snapshot_dir)
+    if version is None:
+        raise FileNotFoundError('No snapshot in %s' % snapshot_dir)
+    with open(os.path.join(snapshot_dir, version, 'meta.json')) as f:
+        return json.load(f)
+
+
+def has_current_snapshot(snapshot_dir=SNAPSHOT_DIR):
+    '''Whether there is a current snapshot in the format this code writes'''
+    try:
+        return read_meta(snapshot_dir)['format'] == SNAPSHOT_FORMAT
+    except FileNotFoundError:
+        return False
+
+
+def states_from_meta(meta):
+    '''The per-state table saved with a snapshot'''
+    states = meta.get('states')
+    if states is None:
+        return pd.DataFrame(columns=STATE_COLS, index=pd.Index([], name='state'))
+    table = pd.DataFrame(states['data'], index=states['index'], columns=states['columns'])
+    table.index.name = 'state'
+    return table
+
+
+def load_snapshot(snapshot_dir=SNAPSHOT_DIR, version=None, mmap=False):
+    '''Load a snapshot written by save_snapshot, returns (df, meta)
+
+    With mmap=True the numeric blocks are memory-mapped read-only and used
+    as the frame's blocks without copying, so every process loading the
+    same version shares one copy of the data through the page cache.
+    Columns come back grouped by block rather than in the saved order.
+    '''
+    meta = read_meta(snapshot_dir, version)
+    path = os.path.join(snapshot_dir, meta['version'])
+    if meta['format'] != SNAPSHOT_FORMAT:
+        raise ValueError('Snapshot %s has format %s, expected %s' %
+                         (meta['version'], meta['format'], SNAPSHOT_FORMAT))
+
+    frames = []
+    for block in meta['blocks']:
+        values = np.load(os.path.join(path, block['file']),
+                         mmap_mode='r' if mmap else None)
+        if block['dtype'] == 'category':
+            frames.append(pd.DataFrame({
+                col: pd.Categorical.from_codes(col_values, meta['categories'][col])
+                for col, col_values in zip(block['columns'], values)}))
+        else:
+            frames.append(pd.DataFrame(
+                values.T, columns=block['columns'], copy=False))
+    df = pd.concat(frames, axis=1, copy=False)
+    return df, meta
+
+
+class Dataset(object):
+    '''The frame served to the callbacks and the snapshot version it came from.
+
+    states holds the per-state census columns (STATE_COLS), indexed by state,
+    dropdown the states dropdown metadata (see dropdown_metadata), cube the
+    CUBE_METRICS as a dense (date x state x metric) array (see cube.Cube)
+    and rankings the per-date state rankings (see ranking.Rankings).
+    These are derived from df unless given in arrays (see load_arrays).
+    '''
+
+    def __init__(self, df, version, states=None, dropdown=None, arrays=None):
+        self.df = df
+        self.version = version
+        self.states = states if states is not None else states_from_meta({})
+        self.dropdown = dropdown if dropdown is not None else dropdown_metadata(df, self.states)
+        self.state_index = build_state_index(df)
+        self.starts = np.array(sorted(s.start for s in self.state_index.values()))
+        self._derived = {}
+        self._state_max = {}
+        if arrays is not None:
+            self.dates = arrays['dates']
+            self.cube = arrays['cube']
+            self.rankings = arrays['rankings']
+        else:
+            self.dates = np.datetime_as_string(df['date_val'].values, unit='D')
+            self.cube = cube.build_cube(self, CUBE_METRICS)
+            self.rankings = ranking.build_rankings(self.cube)
+
+    def column(self, name):
+        '''Values of a column of the frame or of a metric in derived.METRICS.
+
+        Metrics missing from the frame are computed on first use and kept
+        for the life of the Dataset.
+        '''
+        if name in self.df.columns:
+            return self.df[name].values
+        values = self._derived.get(name)
+        if values is None:
+            values = derived.compute_metrics([name], self.column, self.starts)[name]
+            self._derived[name] = values
+        return values
+
+    def state_max(self, column):
+        '''{state: largest value of column}, NaN for states without values'''
+        maxima = self._state_max.get(column)
+        if maxima is None:
+            values = self.cube.metric(column)
+            # fmax skips NaNs, and leaves NaN where a state has only NaNs
+            maxima = dict(zip(self.cube.states, np.fmax.reduce(values, axis=0).tolist()
+                              if len(values) else []))
+            self._state_max[column] = maxima
+        return maxima
+
+    def ordered_states(self, states):
+        '''The known states among states, in frame order'''
+        return sorted((state for state in set(states) if state in self.state_index),
+                      key=lambda state: self.state_index[state].start)
+
+    def state_series(self, state, column):
+        '''(dates, values) arrays for one state, as views into the frame'''
+        rows = self.state_index.get(state, slice(0, 0))
+        return self.dates[rows], self.column(column)[rows]
+
+
+def build_state_index(df):
+    '''Map each state to the slice of its rows in df.
+
+    Relies on df being sorted by state, which both get_CTP_and_Census_data
+    and update_CTP_data guarantee.
+    '''
+    states = df['state'].values
+    starts = derived.group_starts(states)
+    stops = np.r_[starts[1:], len(states)]
+    index = {states[start]: slice(start, stop)
+             for start, stop in zip(starts, stops)}
+    if len(index) != len(starts):
+        raise ValueError('Frame is not sorted by state')
+    return index
+
+
+_dataset = None
+
+
+def get_dataset():
+    '''Return the live Dataset. Callbacks should call this once per request'''
+    return _dataset
+
+
+def set_dataset(dataset):
+    '''Atomically replace the live Dataset'''
+    global _dataset
+    _dataset = dataset
+
+
+def http_cache_dir(snapshot_dir=SNAPSHOT_DIR):
+    return os.path.join(snapshot_dir, 'http_cache')
+
+
+def refresh_snapshot(snapshot_dir=SNAPSHOT_DIR, force=False):
+    '''Rebuild the snapshot from the remote sources.
+
+    Both sources are fetched concurrently with conditional GETs. Returns
+    the new version, or None when neither source changed since the last
+    download and force is not set.
+    '''
+    cache_dir = http_cache_dir(snapshot_dir)
+    sources = fetch.fetch_all({CTP_FILE: CTP_URL, CENSUS_FILE: CENSUS_URL}, cache_dir)
+    if (not force and has_current_snapshot(snapshot_dir) and
+            not any(changed for path, changed in sources.values())):
+        return None
+    try:
+        census_path, census_changed = sources[CENSUS_FILE]
+        census = census_table(census_path, snapshot_dir, census_changed)
+        df = get_CTP_and_Census_data(sources[CTP_FILE][0], census)
+        return save_snapshot(df, snapshot_dir, state_table(df, census))
+    except Exception:
+        # Make the next refresh download and parse the sources again
+        for name in sources:
+            fetch.invalidate(cache_dir, name)
+        raise
+
+
+def update_snapshot(snapshot_dir=SNAPSHOT_DIR):
+    '''Append the new days of the CTP feed to the current snapshot.
+
+    Returns the new version, or None when the feed is unchanged or has no
+    new days. A snapshot in another format is rebuilt from the sources.
+    '''
+    if not has_current_snapshot(snapshot_dir):
+        return refresh_snapshot(snapshot_dir, force=True)
+    cache_dir = http_cache_dir(snapshot_dir)
+    path, changed = fetch.fetch(CTP_URL, cache_dir, CTP_FILE)
+    if not changed:
+        return None
+    try:
+        df, meta = load_snapshot(snapshot_dir, mmap=True)
+        census = census_table(os.path.join(cache_dir, CENSUS_FILE), snapshot_dir, changed=False)
+        df = update_CTP_data(df, census, path)
+        if df is None:
+            return None
+        return save_snapshot(df, snapshot_dir, state_table(df, census))
+    except Exception:
+        fetch.invalidate(cache_dir, CTP_FILE)
+        raise
+
+
+def load_dataset(snapshot_dir=SNAPSHOT_DIR, version=None):
+    '''Load a snapshot version read-only as a Dataset'''
+    df, meta = load_snapshot(snapshot_dir, version, mmap=True)
+    path = os.path.join(snapshot_dir, meta['version'])
+    return Dataset(df, meta['version'], states_from_meta(meta), meta.get('dropdown'),
+                   load_arrays(path, meta, mmap=True))
+
+
+_older = None
+
+
+def dataset_version(version, snapshot_dir=SNAPSHOT_DIR):
+    '''The Dataset of a snapshot version, for pages still showing data a
+    refresh has since replaced. The last older version loaded is kept. The
+    live Dataset when version is unset or no longer in the snapshot store.
+    '''
+    global _older
+    dataset = get_dataset()
+    if version is None or version == dataset.version:
+        return dataset
+    older = _older
+    if older is None or older.version != version:
+        # version comes from the browser, only snapshot names are looked up
+        if not str(version).isdigit():
+            return dataset
+        try:
+            older = load_dataset(snapshot_dir, version)
+        except (FileNotFoundError, ValueError):
+            return dataset
+        _older = older
+    return older
+
+
+def load_data(snapshot_dir=SNAPSHOT_DIR):
+    '''Load the current snapshot as the live Dataset, building one from the
+    network if none exists or it is in another format'''
+    if not has_current_snapshot(snapshot_dir):
+        refresh_snapshot(snapshot_dir, force=True)
+    set_dataset(load_dataset(snapshot_dir))
+    return get_dataset()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Manage the local CTP/Census data snapshot')
+    parser.add_argument('command', choices=['refresh', 'info'])
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR)
+    parser.add_argument('--force', action='store_true',
+                        help='rebuild even if the sources are unchanged')
+    args = parser.parse_args()
+
+    if args.command == 'refresh':
+        start = time.time()
+        version = refresh_snapshot(args.snapshot_dir, args.force)
+        if version is None:
+            print('Sources unchanged, keeping snapshot %s' %
+                  current_version(args.snapshot_dir))
+        else:
+            print('Wrote snapshot %s in %.1fs' % (version, time.time() - start))
+    else:
+        df, meta = load_snapshot(args.snapshot_dir)
+        print('Snapshot %s: %d rows, %d columns' %
+              (meta['version'], meta['rows'], len(meta['columns'])))
+
+
+if __name__ == '__main__':
+    main()
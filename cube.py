@@ -0,0 +1,69 @@
+'''Dense (date x state x metric) cube of a Dataset, kept next to its long frame.
+
+The long frame holds one row per state and day, so anything across states
+has to regroup it by state. In the cube every state has a row for every
+date, NaN where the feed has none. The (date x state) matrix of a metric,
+rolling means and per-million scaling are then plain array operations.
+'''
+import numpy as np
+
+import derived
+
+
+class Cube(object):
+    '''values[i, j, k] is metric k of state j on dates[i].
+
+    Stored metric-major, so the (date x state) matrix of one metric is
+    contiguous. population[j] is the census population of state j.
+    '''
+
+    def __init__(self, dates, states, metrics, values, population):
+        self.dates = dates
+        self.states = states
+        self.metrics = metrics
+        self.values = values
+        self.population = population
+        self.metric_pos = {name: k for k, name in enumerate(metrics)}
+        self._derived = {}
+
+    def metric(self, name):
+        '''(date x state) values of a metric of the cube or of derived.METRICS.
+
+        Derived metrics missing from the cube are computed from their source
+        on first use, on calendar days rather than on each state's rows.
+        '''
+        k = self.metric_pos.get(name)
+        if k is not None:
+            return self.values[:, :, k]
+        values = self._derived.get(name)
+        if values is None:
+            metric = derived.METRICS[name]
+            source = self.metric(metric.source)
+            if metric.kind == derived.ROLLING:
+                values = self.rolling_mean(source)
+            else:
+                values = self.per_million(source)
+            self._derived[name] = values
+        return values
+
+    def rolling_mean(self, values, window=derived.ROLLING_WINDOW):
+        '''Trailing window means down the dates of a (date x state) matrix'''
+        return derived.rolling_means(values, np.array([0]), window).astype('float32')
+
+    def per_million(self, values):
+        '''A (date x state) matrix divided by each state's population in millions'''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (values / (self.population / 1000000)).astype('float32')
+
+
+def build_cube(dataset, metrics):
+    '''The cube of the metrics of dataset, its states in frame order'''
+    days = dataset.column('date_val').astype('datetime64[D]')
+    dates, date_rows = np.unique(days, return_inverse=True)
+    states = dataset.ordered_states(dataset.state_index)
+    state_cols = np.repeat(np.arange(len(states)), np.diff(np.r_[dataset.starts, len(days)]))
+    values = np.full((len(metrics), len(dates), len(states)), np.nan, dtype='float32')
+    for k, name in enumerate(metrics):
+        values[k, date_rows, state_cols] = dataset.column(name)
+    population = np.asarray(dataset.column('Population'), dtype='float64')[dataset.starts]
+    return Cube(dates, states, list(metrics), values.transpose(1, 2, 0), population)
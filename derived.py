@@ -0,0 +1,127 @@
+'''Registry of the metrics derived from the CTP and census base columns.
+
+A metric is declared by its kind and source column, and computed when
+first asked for - see Dataset.column. Metrics of one kind are computed
+together in a single array pass.
+'''
+import numpy as np
+
+ROLLING = 'rolling'
+PER_MILLION = 'per_million'
+ROLLING_WINDOW = 7
+
+ROLLING_COLS = ['deathIncrease', 'positiveIncrease', 'totalTestResultsIncrease',
+                'hospitalizedIncrease', 'hospitalizedCurrently']
+PER_MILLION_COLS = ['positive', 'negative', 'pending',
+                    'hospitalizedCurrently', 'hospitalizedCumulative', 'inIcuCurrently',
+                    'inIcuCumulative', 'onVentilatorCurrently', 'onVentilatorCumulative',
+                    'death', 'hospitalized',
+                    'totalTestsViral', 'positiveTestsViral', 'negativeTestsViral',
+                    'positiveCasesViral', 'positiveIncrease', 'negativeIncrease',
+                    'totalTestResults', 'totalTestResultsIncrease',
+                    'deathIncrease', 'hospitalizedIncrease',
+                    'totalTestResultsIncrease_7day', 'positiveIncrease_7day',
+                    'deathIncrease_7day', 'hospitalizedIncrease_7day', 'hospitalizedCurrently_7day']
+
+
+class Metric(object):
+
+    def __init__(self, name, kind, source):
+        self.name = name
+        self.kind = kind
+        self.source = source
+
+
+METRICS = {}
+
+
+def declare(kind, source):
+    '''Declare a derived metric, returns its column name'''
+    name = source + ('_7day' if kind == ROLLING else '_permil')
+    METRICS[name] = Metric(name, kind, source)
+    return name
+
+
+for col in ROLLING_COLS:
+    declare(ROLLING, col)
+for col in PER_MILLION_COLS:
+    declare(PER_MILLION, col)
+
+# The CTP columns the metrics are derived from
+BASE_COLS = [col for col in dict.fromkeys(ROLLING_COLS + PER_MILLION_COLS)
+             if col not in METRICS]
+
+
+def group_starts(keys):
+    '''Index of the first row of each run of equal values in keys'''
+    keys = np.asarray(getattr(keys, 'codes', keys))
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+
+def rolling_means(values, starts, window=ROLLING_WINDOW):
+    '''Trailing window means down each column of the 2-D array values.
+
+    Rows are grouped into runs beginning at starts. Like
+    groupby().rolling(window).mean(), a row is NaN when its window holds a
+    NaN or reaches back past the start of its run. Computed for every
+    column at once as differences of cumulative sums.
+    '''
+    rows, cols = values.shape
+    valid = ~np.isnan(values)
+    sums = np.zeros((rows + 1, cols))
+    np.cumsum(np.where(valid, values, 0.0), axis=0, out=sums[1:])
+    counts = np.zeros((rows + 1, cols), dtype='int64')
+    np.cumsum(valid, axis=0, out=counts[1:])
+
+    means = np.full((rows, cols), np.nan)
+    if rows >= window:
+        full = counts[window:] - counts[:-window] == window
+        means[window - 1:] = np.where(
+            full, (sums[window:] - sums[:-window]) / window, np.nan)
+    position = np.arange(rows) - np.repeat(starts, np.diff(np.r_[starts, rows]))
+    means[position < window - 1] = np.nan
+    return means
+
+
+def compute_metrics(names, column, starts):
+    '''Compute the metrics names, returns a dict of name -> values.
+
+    column(name) must return the float values of any base or derived
+    column, starts the first row of each state (rows sorted by state and
+    date). Rolling metrics are computed first so that per-million metrics
+    of them can use the results.
+    '''
+    metrics = [METRICS[name] for name in names]
+    results = {}
+
+    def source(name):
+        return results[name] if name in results else column(name)
+
+    for kind in (ROLLING, PER_MILLION):
+        batch = [metric for metric in metrics if metric.kind == kind]
+        if not batch:
+            continue
+        values = np.stack([np.asarray(source(metric.source), dtype='float64')
+                           for metric in batch])
+        if kind == ROLLING:
+            values = rolling_means(values.T, starts).T.copy()
+        else:
+            values /= np.asarray(column('Population'), dtype='float64') / 1000000
+        results.update(zip([metric.name for metric in batch], values))
+    return results
+
+
+def add_metrics(df, names):
+    '''Add the metrics names to df as columns, df must be sorted by state and date'''
+    starts = group_starts(df['state'].values)
+
+    def column(name):
+        if name in df.columns:
+            return df[name].to_numpy(dtype='float64')
+        return compute_metrics([name], column, starts)[name]
+
+    results = compute_metrics(names, column, starts)
+    # Assigned one by one as views, pd.concat would consolidate and so copy
+    # the whole frame
+    for name in names:
+        df[name] = results[name]
@@ -0,0 +1,75 @@
+'''Largest-Triangle-Three-Buckets downsampling of the series sent to the browser.
+
+A line drawn with more points than the plot has pixels looks no different,
+so series are reduced to about one point every PX_PER_POINT pixels of the
+graph width. LTTB keeps the points that shape the line (peaks, troughs),
+unlike taking every nth point.
+'''
+import os
+
+import numpy as np
+
+ENABLED = os.environ.get('CTP_DOWNSAMPLE', '1') != '0'
+PX_PER_POINT = float(os.environ.get('CTP_DOWNSAMPLE_PX_PER_POINT', 3))
+MIN_POINTS = 50
+
+
+def points_for_width(pixels):
+    '''Points to keep per series for a plot pixels wide, None when disabled'''
+    if not ENABLED:
+        return None
+    return max(MIN_POINTS, int(pixels / PX_PER_POINT))
+
+
+def lttb(y, threshold, x=None):
+    '''Indices of the threshold points LTTB keeps of the series y (at x).
+
+    The first and last points are always kept, y must not hold NaNs. Buckets
+    hold only a few points each at plot resolution, so this runs on Python
+    lists, numpy calls per bucket would cost more than they save.
+    '''
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    y = np.asarray(y, dtype='float64').tolist()
+    x = list(range(n)) if x is None else np.asarray(x, dtype='float64').tolist()
+    every = (n - 2) / (threshold - 2)
+    # Bucket i holds the points edges[i] to edges[i + 1] - 1, between the
+    # first and the last point
+    edges = [int(i * every) + 1 for i in range(threshold - 1)]
+    edges[-1] = n - 1
+    edges.append(n)
+    indices = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start, end, next_end = edges[i], edges[i + 1], edges[i + 2]
+        avg_x = sum(x[end:next_end]) / (next_end - end)
+        avg_y = sum(y[end:next_end]) / (next_end - end)
+        ax, ay = x[a], y[a]
+        # Twice the area of the triangle from the last kept point a, each
+        # point of the bucket and the average of the next bucket
+        best, a = -1.0, start
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (y[j] - ay) - (ax - x[j]) * (avg_y - ay))
+            if area > best:
+                best, a = area, j
+        indices.append(a)
+    indices.append(n - 1)
+    return np.array(indices)
+
+
+def downsample(y, points):
+    '''Indices of the points of y to plot, at most about points of them.
+
+    NaNs are not sampled, but the first NaN after a run of values is kept
+    so the gap still breaks the line, as are the first and last points so
+    the x range is unchanged.
+    '''
+    n = len(y)
+    if points is None or n <= points:
+        return np.arange(n)
+    finite = np.isfinite(y)
+    values = np.flatnonzero(finite)
+    keep = values[lttb(y[values], points)]
+    gaps = np.flatnonzero(~finite & np.r_[False, finite[:-1]])
+    return np.union1d(np.union1d(keep, gaps), [0, n - 1])
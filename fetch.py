@@ -0,0 +1,98 @@
+'''HTTP fetch layer for the remote data sources.
+
+Downloads go through one pooled requests session with bounded retries and
+are cached on disk together with their ETag/Last-Modified validators, so
+an unchanged source costs a 304 and is not parsed again.
+'''
+import contextlib
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRIES = int(os.environ.get('CTP_FETCH_RETRIES', 3))
+# (connect, read) timeouts in seconds
+TIMEOUT = (5, int(os.environ.get('CTP_FETCH_TIMEOUT', 60)))
+CHUNK_SIZE = 1024 * 1024
+
+_session = None
+
+
+def get_session():
+    global _session
+    if _session is None:
+        retry = Retry(total=RETRIES, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _session = session
+    return _session
+
+
+def fetch(url, cache_dir, name):
+    '''Download url into cache_dir/name, returns (path, changed).
+
+    Sends the validators of the cached copy, changed is False when the
+    server answers 304 and the cached file is still current.
+    '''
+    path = os.path.join(cache_dir, name)
+    validators_path = path + '.json'
+    headers = {}
+    if os.path.exists(path) and os.path.exists(validators_path):
+        with open(validators_path) as f:
+            validators = json.load(f)
+        if validators.get('url') == url:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+    with get_session().get(url, headers=headers, timeout=TIMEOUT, stream=True) as response:
+        if response.status_code == 304:
+            return path, False
+        response.raise_for_status()
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+        os.replace(path + '.tmp', path)
+        with open(validators_path, 'w') as f:
+            json.dump({'url': url,
+                       'etag': response.headers.get('ETag'),
+                       'last_modified': response.headers.get('Last-Modified')}, f)
+    return path, True
+
+
+def fetch_all(sources, cache_dir):
+    '''Fetch {name: url} concurrently, returns {name: (path, changed)}'''
+    with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+        jobs = {name: pool.submit(fetch, url, cache_dir, name)
+                for name, url in sources.items()}
+        return {name: job.result() for name, job in jobs.items()}
+
+
+def invalidate(cache_dir, name):
+    '''Forget the validators of a cached download, the next fetch is unconditional'''
+    try:
+        os.remove(os.path.join(cache_dir, name) + '.json')
+    except FileNotFoundError:
+        pass
+
+
+@contextlib.contextmanager
+def open_text(source):
+    '''Open a local path or a URL as a text file, URLs are streamed'''
+    if '://' not in source:
+        with open(source, encoding='utf-8') as f:
+            yield f
+        return
+    with get_session().get(source, timeout=TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        yield io.TextIOWrapper(response.raw, encoding='utf-8')
@@ -0,0 +1,91 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import plotly.utils
+
+
+def figure_key(figure_id, states, version, variant=None):
+    '''Cache key for a figure built from a state selection of a data version.
+
+    variant tells apart figures built differently from the same data, like
+    the downsampled point count.
+    '''
+    return (figure_id, tuple(sorted(set(states))), version, variant)
+
+
+def figure_size(figure):
+    '''Serialized size of a figure in bytes'''
+    return len(json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder))
+
+
+class FigureCache(object):
+    '''Thread safe LRU cache of built figures.
+
+    Bounded by the total serialized size of the entries, and entries expire
+    ttl seconds after they were built. The cache empties itself when it sees
+    a new data version.
+    '''
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version = None
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check_version(self, version):
+        '''Drop every entry when version differs from the cached data version'''
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.bytes = 0
+                self.version = version
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[2] < time.time():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, figure, size=None):
+        '''Cache figure, go.Figure objects are stored as plain dicts'''
+        if hasattr(figure, 'to_plotly_json'):
+            figure = figure.to_plotly_json()
+        size = figure_size(figure) if size is None else size
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (figure, size, time.time() + self.ttl)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def get_or_build(self, key, build, *args):
+        '''Return the cached figure for key, building it with build(*args) on a miss'''
+        figure = self.get(key)
+        if figure is None:
+            figure = build(*args)
+            self.put(key, figure)
+        return figure
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def _remove(self, key):
+        figure, size, expires = self._entries.pop(key)
+        self.bytes -= size
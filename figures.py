@@ -0,0 +1,231 @@
+'''Lean line figure builders for the dropdown driven graphs.
+
+Build the same figures as the px.line calls they replace, as plain dicts
+made straight from each state's slice of the Dataset arrays, skipping
+plotly express's validation and grouping.
+'''
+import base64
+import math
+import os
+
+import numpy as np
+import plotly.express as px
+import plotly.io as pio
+
+import downsample
+import instrumentation
+
+COLORS = px.colors.qualitative.Plotly
+FACET_COL_SPACING = 0.02
+FACET_ROW_SPACING = 0.07
+# Figures with more points use WebGL in 'auto' mode, the same cut-off as px
+WEBGL_THRESHOLD = 1000
+RENDER_MODE = os.environ.get('CTP_LINE_RENDER_MODE', 'auto')
+# 'binary' sends trace arrays base64 encoded (see encode_arrays), 'json' as lists
+ENCODING = os.environ.get('CTP_FIGURE_ENCODING', 'binary')
+
+_template = None
+
+
+def get_template():
+    '''The default plotly template as a dict, px adds it to every figure'''
+    global _template
+    if _template is None:
+        _template = pio.templates[pio.templates.default].to_plotly_json()
+    return _template
+
+
+def trace_type(points, render_mode=RENDER_MODE):
+    if render_mode == 'webgl' or (render_mode == 'auto' and points > WEBGL_THRESHOLD):
+        return 'scattergl'
+    return 'scatter'
+
+
+def line_traces(dataset, states, y, render_mode=RENDER_MODE, axes=None, points=None):
+    '''One line trace per state, on the axis suffixes in axes if given.
+
+    With points set each state's series is downsampled to about that many
+    points, see downsample.downsample.
+    '''
+    with instrumentation.phase('filter'):
+        series = [dataset.state_series(state, y) for state in states]
+    if points is not None:
+        with instrumentation.phase('downsample'):
+            series = [(x[rows], values[rows]) for x, values in series
+                      for rows in [downsample.downsample(values, points)]]
+    kind = trace_type(sum(len(x) for x, values in series), render_mode)
+    data = []
+    for i, (state, (x, values)) in enumerate(zip(states, series)):
+        axis = axes[i] if axes else ''
+        trace = {'type': kind,
+                 'mode': 'lines',
+                 'name': state,
+                 'legendgroup': state,
+                 'showlegend': True,
+                 'line': {'color': COLORS[i % len(COLORS)], 'dash': 'solid'},
+                 'hovertemplate': '<b>%s</b><br><br>state=%s<br>date_val=%%{x}<br>%s=%%{y}<extra></extra>'
+                                  % (state, state, y),
+                 'x': x,
+                 'y': json_floats(values),
+                 'xaxis': 'x' + axis,
+                 'yaxis': 'y' + axis}
+        if kind == 'scatter':
+            trace['orientation'] = 'v'
+        data.append(trace)
+    return data
+
+
+def line_figure(dataset, states, y, title, render_mode=RENDER_MODE, points=None):
+    '''One line per state, like px.line(x='date_val', y=y, color='state')'''
+    data = line_traces(dataset, dataset.ordered_states(states), y, render_mode,
+                       points=points)
+    layout = {'template': get_template(),
+              'xaxis': {'anchor': 'y', 'domain': [0.0, 1.0], 'title': {'text': 'date_val'}},
+              'yaxis': {'anchor': 'x', 'domain': [0.0, 1.0], 'title': {'text': y}},
+              'legend': {'title': {'text': 'state'}, 'tracegroupgap': 0},
+              'title': {'text': title}}
+    return {'data': data, 'layout': layout}
+
+
+def facet_line_figure(dataset, states, y, title, wrap=4, width=800, render_mode=RENDER_MODE,
+                      points=None):
+    '''One subplot per state, like px.line(..., facet_col='state', facet_col_wrap=wrap)'''
+    states = dataset.ordered_states(states)
+    ncols = max(1, min(len(states), wrap))
+    nrows = max(1, int(math.ceil(len(states) / float(ncols))))
+    # Same arithmetic as make_subplots, so the domains match px exactly
+    col_width = (1.0 - FACET_COL_SPACING * (ncols - 1)) * (1.0 / ncols)
+    row_height = (1.0 - FACET_ROW_SPACING * (nrows - 1)) * (1.0 / nrows)
+
+    layout = {'template': get_template(),
+              'annotations': [],
+              'legend': {'title': {'text': 'state'}, 'tracegroupgap': 0},
+              'title': {'text': title},
+              'width': width}
+    # Subplots are numbered from the bottom left, facets fill from the top left
+    for row in range(nrows):
+        for col in range(ncols):
+            n = row * ncols + col + 1
+            suffix = str(n) if n > 1 else ''
+            x_start = sum([col_width] * col) + col * FACET_COL_SPACING
+            y_start = sum([row_height] * row) + row * FACET_ROW_SPACING
+            x_domain = [x_start, x_start + col_width]
+            y_domain = [y_start, y_start + row_height]
+            xaxis = {'anchor': 'y' + suffix, 'domain': x_domain}
+            yaxis = {'anchor': 'x' + suffix, 'domain': y_domain}
+            if n > 1:
+                xaxis['matches'] = 'x'
+                yaxis['matches'] = 'y'
+            if row == 0:
+                xaxis['title'] = {'text': 'date_val'}
+            else:
+                xaxis['showticklabels'] = False
+            if col == 0:
+                yaxis['title'] = {'text': y}
+            else:
+                yaxis['showticklabels'] = False
+            layout['xaxis' + suffix] = xaxis
+            layout['yaxis' + suffix] = yaxis
+
+    axes = []
+    for i in range(len(states)):
+        n = (nrows - 1 - i // ncols) * ncols + i % ncols + 1
+        axes.append(str(n) if n > 1 else '')
+    data = line_traces(dataset, states, y, render_mode, axes, points)
+    for state, axis in sorted(zip(states, axes), key=lambda item: int(item[1] or 1)):
+        x_domain = layout['xaxis' + axis]['domain']
+        layout['annotations'].append({
+            'font': {}, 'showarrow': False, 'text': 'state=' + state,
+            'x': (x_domain[0] + x_domain[1]) / 2, 'xanchor': 'center', 'xref': 'paper',
+            'y': layout['yaxis' + axis]['domain'][1], 'yanchor': 'bottom', 'yref': 'paper'})
+    return {'data': data, 'layout': layout}
+
+
+def json_floats(values):
+    '''float32 values as float64 rounded to 7 significant digits.
+
+    Serializing float32 values directly carries their representation noise
+    (124.28571319580078), the rounded values serialize as short as the
+    float32 precision warrants (124.2857).
+    '''
+    if values.dtype != np.float32:
+        return values
+    values = values.astype('float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exponent = np.floor(np.log10(np.abs(values)))
+    exponent = np.where(np.isfinite(exponent), exponent, 0) - 6
+    scale = 10.0 ** np.abs(exponent)
+    # Dividing or multiplying exact integers by powers of ten keeps the
+    # shortest decimal representation
+    return np.where(exponent < 0, np.round(values * scale) / scale,
+                    np.round(values / scale) * scale)
+
+
+def encode_arrays(figure):
+    '''Replace the trace arrays of figure by base64 encoded binary.
+
+    Dates become days since the epoch and values float32, a fraction of
+    the size of their JSON lists. The browser turns them back into typed
+    arrays with ctp.decodeFigure in assets/figures.js. The x axes are typed
+    as dates, as their values are numbers once decoded.
+    '''
+    for trace in figure['data']:
+        for key in ('x', 'y'):
+            if isinstance(trace.get(key), np.ndarray):
+                trace[key] = encode_array(trace[key])
+    for name, axis in figure['layout'].items():
+        if name.startswith('xaxis'):
+            axis['type'] = 'date'
+    return figure
+
+
+def encode_array(values):
+    if values.dtype.kind in 'USOM':
+        values = values.astype('datetime64[D]').astype('<i4')
+        dtype = 'days'
+    else:
+        values = values.astype('<f4')
+        dtype = 'f4'
+    return {'dtype': dtype, 'b64': base64.b64encode(values.tobytes()).decode('ascii')}
+
+
+def nice_axis(max_value, ticks=5):
+    '''(upper bound, tick step) for an axis from 0 to max_value.
+
+    The step is 1, 2 or 5 times a power of ten giving at most about ticks
+    intervals, the bound the first step at or above max_value.
+    '''
+    if not max_value > 0 or not math.isfinite(max_value):
+        return 10, 2
+    raw = max_value / ticks
+    power = 10 ** math.floor(math.log10(raw))
+    step = next(factor * power for factor in (1, 2, 5, 10) if factor * power >= raw)
+    # Rounded, step multiples like 3 * 0.2 carry float noise
+    return round(math.ceil(max_value / step - 1e-9) * step, 12), step
+
+
+def client_config():
+    '''The constants the browser needs to build figures like the ones above,
+    see ctp.buildFigures in assets/figures.js'''
+    return {'template': get_template(),
+            'colors': COLORS,
+            'render_mode': RENDER_MODE,
+            'webgl_threshold': WEBGL_THRESHOLD,
+            'facet_col_spacing': FACET_COL_SPACING,
+            'facet_row_spacing': FACET_ROW_SPACING}
+
+
+def encode_series(dataset, columns):
+    '''Every state's dates and columns, encoded like encode_arrays does.
+
+    Returns {'order': states in frame order, 'states': {state: {'days': ...,
+    column: ...}}}.
+    '''
+    dates = dataset.column('date_val')
+    states = dataset.ordered_states(dataset.state_index)
+    series = {}
+    for state in states:
+        rows = dataset.state_index[state]
+        series[state] = dict([('days', encode_array(dates[rows]))] +
+                             [(col, encode_array(dataset.column(col)[rows])) for col in columns])
+    return {'order': states, 'states': series}
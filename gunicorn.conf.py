@@ -0,0 +1,17 @@
+# gunicorn settings for the shared data plane deployment
+#
+# preload_app imports app.py once in the master before forking, so the
+# snapshot is loaded (memory-mapped read-only) a single time and every
+# worker shares those pages instead of building its own copy of the frame.
+import os
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Every worker swaps in new snapshots, the refresh lock makes sure only
+    # one of them fetches new days at a time
+    import refresher
+    refresher.start_refresher()
@@ -0,0 +1,167 @@
+'''Callback and figure metrics, served in the Prometheus text format on /metrics.
+
+Metrics are kept per process, each gunicorn worker reports its own.
+
+Figure builds are timed in a span, code running inside one adds named
+phases with phase(), e.g. the per-state filtering in figures.line_traces.
+The rest of the span counts as 'build'.
+'''
+import bisect
+import contextlib
+import functools
+import threading
+import time
+
+import flask
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+_metrics = []
+
+
+def _format_labels(labels):
+    labels = list(labels)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
+
+
+class Histogram(object):
+
+    def __init__(self, name, help, labelnames=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, (counts, total) in values:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    self.name, _format_labels(labels + [('le', bound)]), cumulative))
+            lines.append('%s_sum%s %r' % (self.name, _format_labels(labels), total))
+            lines.append('%s_count%s %d' % (self.name, _format_labels(labels), cumulative))
+        return lines
+
+
+class Gauge(object):
+    '''A value read when rendered, collect() returns {label values: value}.
+
+    kind='counter' for values that only grow, like the figure cache hits.
+    '''
+
+    def __init__(self, name, help, collect, labelnames=(), kind='gauge'):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+        _metrics.append(self)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for key, value in sorted(self.collect().items()):
+            lines.append('%s%s %r' % (self.name, _format_labels(zip(self.labelnames, key)), value))
+        return lines
+
+
+CALLBACK_SECONDS = Histogram('ctp_callback_seconds', 'Wall time of Dash callbacks',
+                             ['callback'])
+CALLBACK_STATES = Histogram('ctp_callback_states', 'Number of states selected per callback',
+                            ['callback'], COUNT_BUCKETS)
+FIGURE_SECONDS = Histogram('ctp_figure_seconds', 'Figure build time by phase',
+                           ['figure', 'phase'])
+FIGURE_BYTES = Histogram('ctp_figure_bytes', 'Serialized size of built figures',
+                         ['figure'], BYTES_BUCKETS)
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def span(figure):
+    '''Time building figure, recording the phases added inside the block'''
+    phases = {}
+    outer = getattr(_local, 'phases', None)
+    _local.phases = phases
+    start = time.perf_counter()
+    try:
+        yield phases
+    finally:
+        _local.phases = outer
+        elapsed = time.perf_counter() - start
+        phases['build'] = elapsed - sum(phases.values())
+        for name, seconds in phases.items():
+            FIGURE_SECONDS.observe(seconds, figure=figure, phase=name)
+
+
+@contextlib.contextmanager
+def phase(name):
+    '''Add the time spent in the block to phase name of the current span'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases = getattr(_local, 'phases', None)
+        if phases is not None:
+            phases[name] = phases.get(name, 0.0) + time.perf_counter() - start
+
+
+def timed_serialize(figure_id, serialize, *args):
+    '''Call serialize(*args), recording its time and the size it returns'''
+    start = time.perf_counter()
+    size = serialize(*args)
+    FIGURE_SECONDS.observe(time.perf_counter() - start, figure=figure_id, phase='serialize')
+    FIGURE_BYTES.observe(size, figure=figure_id)
+    return size
+
+
+def instrument_callback(func=None, states_arg=None):
+    '''Record the wall time of a callback, and the number of states in its
+    positional argument states_arg when given'''
+    if func is None:
+        return functools.partial(instrument_callback, states_arg=states_arg)
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            CALLBACK_SECONDS.observe(time.perf_counter() - start, callback=func.__name__)
+            if states_arg is not None:
+                CALLBACK_STATES.observe(len(args[states_arg] or []), callback=func.__name__)
+    return wrapper
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def add_metrics_route(server, path='/metrics'):
+    '''Serve the metrics of this process on the Flask server'''
+    @server.route(path)
+    def metrics():
+        return flask.Response(render(), mimetype='text/plain; version=0.0.4')
+    return metrics
@@ -0,0 +1,120 @@
+'''Streaming reader for JSON documents holding one array of records.
+
+Records are decoded one at a time from a chunked buffer and only the wanted
+fields are copied into typed numpy buffers, so the whole document is never
+held in memory as text or as Python objects.
+'''
+import json
+
+import numpy as np
+import pandas as pd
+
+CHUNK_SIZE = 1024 * 1024
+INITIAL_ROWS = 4096
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+def iter_records(f, chunk_size=CHUNK_SIZE):
+    '''Yield the items of the top level JSON array read from the text file f'''
+    stream = _Stream(f, chunk_size)
+    if stream.buf.startswith('\ufeff'):
+        stream.pos = 1
+    if stream.peek() != '[':
+        raise ValueError('Expected a JSON array')
+    stream.pos += 1
+    if stream.peek() == ']':
+        return
+    while True:
+        if not stream.peek():
+            raise ValueError('Unterminated JSON array')
+        try:
+            record, end = _decoder.raw_decode(stream.buf, stream.pos)
+        except json.JSONDecodeError:
+            # Most likely a record cut off by the end of the chunk
+            if not stream.read():
+                raise
+            continue
+        # A number may go on in the next chunk
+        if end == len(stream.buf) and stream.read():
+            continue
+        yield record
+        stream.pos = end
+        separator = stream.peek()
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError('Expected , or ] after a record of the JSON array')
+        stream.pos += 1
+
+
+class _Stream(object):
+    '''The unread text of f, buf from pos'''
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = f.read(chunk_size)
+        self.pos = 0
+
+    def read(self):
+        '''Append the next chunk to the unread text, False at the end of f'''
+        chunk = self.f.read(self.chunk_size)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return bool(chunk)
+
+    def peek(self):
+        '''The next character that is not whitespace, reading on as needed, '' at the end'''
+        while True:
+            buf, pos = self.buf, self.pos
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            self.pos = pos
+            if pos < len(buf) or not self.read():
+                return self.buf[self.pos:self.pos + 1]
+
+
+def read_frame(f, schema, chunk_size=CHUNK_SIZE):
+    '''Read the records of the JSON array in f as a DataFrame of the schema columns.
+
+    schema maps field names to dtypes, fields missing from a record are NaN.
+    'category' fields are collected as codes and become Categoricals with
+    sorted categories, like astype('category').
+    '''
+    size = INITIAL_ROWS
+    buffers = {}
+    categories = {}
+    for col, dtype in schema.items():
+        if dtype == 'category':
+            buffers[col] = np.empty(size, dtype='int32')
+            categories[col] = {}
+        else:
+            buffers[col] = np.empty(size, dtype=dtype)
+    rows = 0
+    for record in iter_records(f, chunk_size):
+        if rows == size:
+            size *= 2
+            for col, values in buffers.items():
+                buffers[col] = np.resize(values, size)
+        for col, values in buffers.items():
+            value = record.get(col)
+            if col in categories:
+                codes = categories[col]
+                value = codes.setdefault(value, len(codes)) if value is not None else -1
+            values[rows] = value
+        rows += 1
+
+    columns = {}
+    for col, values in buffers.items():
+        values = values[:rows]
+        if col in categories:
+            names = np.array(list(categories[col]), dtype=object)
+            order = np.argsort(names)
+            remap = np.empty(len(names) + 1, dtype='int32')
+            remap[order] = np.arange(len(names))
+            remap[-1] = -1
+            values = pd.Categorical.from_codes(remap[values], names[order])
+        columns[col] = values
+    return pd.DataFrame(columns)
@@ -0,0 +1,63 @@
+'''Per-date rankings of the states, precomputed from Dataset.cube.
+
+For every ranked metric and statistic the states are argsorted on every
+date once, when a Dataset is loaded after a refresh. Ranking the states
+on a date is then a lookup of one row of orders, rather than a scan and
+sort of the long frame per request.
+'''
+import numpy as np
+
+import derived
+
+# The statistics states are ranked on, and their labels
+STATS = {'latest': 'Value',
+         'wow': 'Change over 7 days',
+         'peak': 'Peak to date'}
+METRICS = [name for name in derived.METRICS if name.endswith('_7day_permil')]
+WEEK = 7
+
+
+def stat_values(values, stat):
+    '''(date x state) values of a statistic of the (date x state) values of a metric'''
+    if stat == 'latest':
+        return values
+    if stat == 'wow':
+        change = np.full_like(values, np.nan)
+        change[WEEK:] = values[WEEK:] - values[:-WEEK]
+        return change
+    if stat == 'peak':
+        # fmax skips the NaNs before a state's first value
+        return np.fmax.accumulate(values, axis=0)
+    raise ValueError('Unknown statistic %r' % stat)
+
+
+class Rankings(object):
+    '''values[metric, stat] the (date x state) statistic values, orders[metric, stat]
+    the state columns on each date from highest to lowest, NaNs last'''
+
+    def __init__(self, states, values, orders):
+        self.states = states
+        self.values = values
+        self.orders = orders
+
+    def top(self, metric, stat, date_index, n=None):
+        '''[(state, value)] of the states ranked on date_index, without those with no value'''
+        key = (metric, stat)
+        order = self.orders[key][date_index]
+        values = self.values[key][date_index][order]
+        count = int(np.isfinite(values).sum())
+        count = count if n is None else min(int(n), count)
+        return [(self.states[j], float(value)) for j, value in zip(order[:count], values[:count])]
+
+
+def build_rankings(cube, metrics=METRICS):
+    values = {}
+    orders = {}
+    for metric in metrics:
+        source = cube.metric(metric)
+        for stat in STATS:
+            key = (metric, stat)
+            values[key] = stat_values(source, stat)
+            # argsort puts NaNs last, negating sorts from the highest
+            orders[key] = np.argsort(-values[key], axis=1, kind='stable').astype('int16')
+    return Rankings(cube.states, values, orders)
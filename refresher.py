@@ -0,0 +1,76 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+
+import ctp_data
+
+logger = logging.getLogger(__name__)
+
+# How often the CTP feed is checked for new days, and how often each process
+# looks for a snapshot written by another process
+REFRESH_INTERVAL = int(os.environ.get('CTP_REFRESH_INTERVAL', 3600))
+POLL_INTERVAL = int(os.environ.get('CTP_POLL_INTERVAL', 60))
+
+
+def snapshot_age(snapshot_dir=ctp_data.SNAPSHOT_DIR):
+    '''Seconds since the current snapshot was written or last checked'''
+    return time.time() - os.path.getmtime(os.path.join(snapshot_dir, 'CURRENT'))
+
+
+def fetch_new_days(snapshot_dir=ctp_data.SNAPSHOT_DIR):
+    '''Append newly published days to the current snapshot.
+
+    Only one process per snapshot directory fetches at a time, the others
+    skip and pick up the result through poll_snapshot. Returns the new
+    version, or None if nothing was written.
+    '''
+    with open(os.path.join(snapshot_dir, 'refresh.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        if snapshot_age(snapshot_dir) < REFRESH_INTERVAL:
+            return None
+        version = ctp_data.update_snapshot(snapshot_dir)
+        if version is None:
+            # Nothing new, mark the snapshot as checked
+            os.utime(os.path.join(snapshot_dir, 'CURRENT'))
+        return version
+
+
+def poll_snapshot(snapshot_dir=ctp_data.SNAPSHOT_DIR):
+    '''Swap in the current snapshot if it is newer than the live Dataset'''
+    version = ctp_data.current_version(snapshot_dir)
+    dataset = ctp_data.get_dataset()
+    if version is None or (dataset is not None and dataset.version == version):
+        return False
+    ctp_data.set_dataset(ctp_data.load_dataset(snapshot_dir, version))
+    logger.info('Swapped in snapshot %s', version)
+    return True
+
+
+def refresh_loop(snapshot_dir, fetch):
+    while True:
+        time.sleep(POLL_INTERVAL)
+        try:
+            if fetch and snapshot_age(snapshot_dir) >= REFRESH_INTERVAL:
+                version = fetch_new_days(snapshot_dir)
+                if version:
+                    logger.info('Wrote snapshot %s', version)
+            poll_snapshot(snapshot_dir)
+        except Exception:
+            logger.exception('Data refresh failed, keeping the loaded data')
+
+
+def start_refresher(snapshot_dir=ctp_data.SNAPSHOT_DIR, fetch=True):
+    '''Start the background refresh thread for this process.
+
+    Call after forking - threads do not survive fork. With fetch=False the
+    process only swaps in snapshots written by others.
+    '''
+    thread = threading.Thread(target=refresh_loop, args=(snapshot_dir, fetch),
+                              name='ctp-refresher', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,219 @@
+'''fetch.py and the conditional refresh, against a local stand-in HTTP server.'''
+import json
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import ctp_data
+import fetch
+
+CENSUS_HEADER = ['Year', 'LocationAbbr', 'LocationDesc', 'TopicType', 'TopicDesc', 'DataSource',
+                 'Data_Value_Type', 'Population', 'Gender', 'Age', 'GeoLocation',
+                 'Source_File_USCB', 'Data_Pulled', 'LocationID', 'TopicTypeId', 'TopicId',
+                 'MeasureId', 'StratificationID1', 'StratificationID2', 'SubMeasureID',
+                 'DisplayOrder']
+STATES = {'FL': ('Florida', 21477737, '(28.93, -81.93)'),
+          'NY': ('New York', 19453561, '(42.83, -75.54)')}
+
+
+def ctp_feed(days=10):
+    records = [{'date': 20200301 + day, 'state': state, 'positive': day * 10,
+                'positiveIncrease': day, 'totalTestResultsIncrease': day * 5,
+                'deathIncrease': 1, 'hospitalizedIncrease': 2, 'hospitalizedCurrently': 3}
+               for day in range(days) for state in STATES]
+    return json.dumps(records[::-1]).encode()
+
+
+def census_csv():
+    rows = [','.join(CENSUS_HEADER)]
+    for state, (name, population, location) in STATES.items():
+        rows.append(','.join(['2018', state, name, 'Demographics', 'Population', 'Census',
+                              'Number', str(population), 'Total', 'Total', '"%s"' % location]
+                             + ['x'] * 10))
+    return ('\n'.join(rows) + '\n').encode()
+
+
+class StandIn(object):
+    '''What the stand-in server serves and what it saw.
+
+    files maps paths to (body, ETag, Last-Modified), failures to the number
+    of 503s to answer before serving, delay slows every response down.
+    '''
+
+    def __init__(self):
+        self.files = {}
+        self.failures = {}
+        self.delay = 0
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def serve(self, path, body, etag=None, last_modified=None):
+        self.files[path] = (body, etag, last_modified)
+
+    def statuses(self, path):
+        return [status for seen, headers, status in self.requests if seen == path]
+
+    def handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                # Recorded before responding, the client may read requests
+                # as soon as it has the response
+                self.request_seen = [self.path, dict(self.headers), None]
+                with stand_in.lock:
+                    stand_in.requests.append(self.request_seen)
+                    stand_in.active += 1
+                    stand_in.max_active = max(stand_in.max_active, stand_in.active)
+                try:
+                    time.sleep(stand_in.delay)
+                    self.respond()
+                finally:
+                    with stand_in.lock:
+                        stand_in.active -= 1
+
+            def respond(self):
+                if stand_in.failures.get(self.path):
+                    stand_in.failures[self.path] -= 1
+                    return self.reply(503)
+                if self.path not in stand_in.files:
+                    return self.reply(404)
+                body, etag, last_modified = stand_in.files[self.path]
+                if ((etag and self.headers.get('If-None-Match') == etag) or
+                        (last_modified and self.headers.get('If-Modified-Since') == last_modified)):
+                    return self.reply(304)
+                headers = {'ETag': etag, 'Last-Modified': last_modified}
+                return self.reply(200, body, {k: v for k, v in headers.items() if v})
+
+            def reply(self, status, body=b'', headers={}):
+                self.request_seen[2] = status
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def server():
+    stand_in = StandIn()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), stand_in.handler())
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    stand_in.url = 'http://127.0.0.1:%d' % httpd.server_port
+    # A fresh session per test, the pooled one would outlive the server
+    fetch._session = None
+    yield stand_in
+    httpd.shutdown()
+    httpd.server_close()
+    fetch._session = None
+
+
+def test_fetch_downloads_into_cache(server, tmp_path):
+    server.serve('/daily.json', b'[1, 2]', etag='"v1"')
+    path, changed = fetch.fetch(server.url + '/daily.json', str(tmp_path), 'ctp.json')
+    assert changed
+    assert path == str(tmp_path / 'ctp.json')
+    with open(path, 'rb') as f:
+        assert f.read() == b'[1, 2]'
+    with open(path + '.json') as f:
+        assert json.load(f)['etag'] == '"v1"'
+
+
+def test_fetch_not_modified_with_etag(server, tmp_path):
+    server.serve('/daily.json', b'[1, 2]', etag='"v1"')
+    url = server.url + '/daily.json'
+    fetch.fetch(url, str(tmp_path), 'ctp.json')
+    path, changed = fetch.fetch(url, str(tmp_path), 'ctp.json')
+    assert not changed
+    assert server.statuses('/daily.json') == [200, 304]
+    assert server.requests[-1][1]['If-None-Match'] == '"v1"'
+    with open(path, 'rb') as f:
+        assert f.read() == b'[1, 2]'
+
+
+def test_fetch_not_modified_with_last_modified(server, tmp_path):
+    stamp = formatdate(usegmt=True)
+    server.serve('/rows.csv', b'a,b\n', last_modified=stamp)
+    url = server.url + '/rows.csv'
+    fetch.fetch(url, str(tmp_path), 'census.csv')
+    assert fetch.fetch(url, str(tmp_path), 'census.csv')[1] is False
+    assert server.requests[-1][1]['If-Modified-Since'] == stamp
+
+
+def test_fetch_changed_source(server, tmp_path):
+    url = server.url + '/daily.json'
+    server.serve('/daily.json', b'[1]', etag='"v1"')
+    fetch.fetch(url, str(tmp_path), 'ctp.json')
+    server.serve('/daily.json', b'[1, 2, 3]', etag='"v2"')
+    path, changed = fetch.fetch(url, str(tmp_path), 'ctp.json')
+    assert changed
+    with open(path, 'rb') as f:
+        assert f.read() == b'[1, 2, 3]'
+
+
+def test_fetch_retries_server_errors(server, tmp_path):
+    server.serve('/daily.json', b'[]', etag='"v1"')
+    server.failures['/daily.json'] = 2
+    path, changed = fetch.fetch(server.url + '/daily.json', str(tmp_path), 'ctp.json')
+    assert changed
+    assert server.statuses('/daily.json') == [503, 503, 200]
+
+
+def test_invalidate_forces_unconditional_fetch(server, tmp_path):
+    server.serve('/daily.json', b'[]', etag='"v1"')
+    url = server.url + '/daily.json'
+    fetch.fetch(url, str(tmp_path), 'ctp.json')
+    fetch.invalidate(str(tmp_path), 'ctp.json')
+    path, changed = fetch.fetch(url, str(tmp_path), 'ctp.json')
+    assert changed
+    assert 'If-None-Match' not in server.requests[-1][1]
+    assert server.statuses('/daily.json') == [200, 200]
+
+
+def test_fetch_all_fetches_concurrently(server, tmp_path):
+    server.serve('/daily.json', b'[]', etag='"a"')
+    server.serve('/rows.csv', b'a,b\n', etag='"b"')
+    server.delay = 0.3
+    results = fetch.fetch_all({'ctp.json': server.url + '/daily.json',
+                               'census.csv': server.url + '/rows.csv'}, str(tmp_path))
+    assert {name: changed for name, (path, changed) in results.items()} == \
+        {'ctp.json': True, 'census.csv': True}
+    assert server.max_active == 2
+
+
+def test_refresh_snapshot_skips_unchanged_sources(server, tmp_path, monkeypatch):
+    server.serve('/daily.json', ctp_feed(), etag='"ctp1"')
+    server.serve('/rows.csv', census_csv(), last_modified=formatdate(usegmt=True))
+    monkeypatch.setattr(ctp_data, 'CTP_URL', server.url + '/daily.json')
+    monkeypatch.setattr(ctp_data, 'CENSUS_URL', server.url + '/rows.csv')
+    parses = []
+    parse = ctp_data.get_CTP_and_Census_data
+    monkeypatch.setattr(ctp_data, 'get_CTP_and_Census_data',
+                        lambda *args: parses.append(args) or parse(*args))
+    snapshot_dir = str(tmp_path)
+
+    version = ctp_data.refresh_snapshot(snapshot_dir)
+    assert version == ctp_data.current_version(snapshot_dir)
+    assert len(parses) == 1
+
+    assert ctp_data.refresh_snapshot(snapshot_dir) is None
+    assert len(parses) == 1
+    assert server.statuses('/daily.json') == [200, 304]
+    assert server.statuses('/rows.csv') == [200, 304]
+    assert ctp_data.current_version(snapshot_dir) == version
+
+    df, meta = ctp_data.load_snapshot(snapshot_dir)
+    assert sorted(df['state'].unique()) == ['FL', 'NY']